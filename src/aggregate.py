@@ -0,0 +1,173 @@
+import numpy as np
+import pandas as pd
+
+def category_counts(group_codes, n_groups, category_codes, n_categories):
+    # Count every (group, category) pair with a single bincount over combined codes
+    valid = (group_codes >= 0) & (category_codes >= 0)
+    combined = group_codes[valid] * n_categories + category_codes[valid]
+    counts = np.bincount(combined, minlength=n_groups * n_categories)
+    return counts.reshape(n_groups, n_categories)
+
+def mode_of_counts(counts, categories):
+    # argmax keeps the first maximum, so ties resolve to the least severe category
+    counts = np.asarray(counts)
+    codes = np.where(counts.sum(axis=1) > 0, counts.argmax(axis=1), -1)
+    dtype = pd.CategoricalDtype(categories, ordered=True)
+    return pd.Categorical.from_codes(codes, dtype=dtype)
+
+def category_mode(data, by, column='AQI_cat'):
+    # Most frequent category of an ordered categorical column for each group
+    group_codes, groups = pd.factorize(data[by], sort=True)
+    values = data[column]
+    counts = category_counts(group_codes, len(groups),
+                             values.cat.codes.to_numpy(), len(values.cat.categories))
+    return pd.Series(mode_of_counts(counts, values.cat.categories),
+                     index=pd.Index(groups, name=by), name=column)
+
+def lttb(x, y, n_out):
+    # Largest-triangle-three-buckets: indices of n_out points that keep the shape of y(x).
+    # Points with a missing value are never kept.
+    finite = np.isfinite(y)
+    if not finite.all():
+        positions = np.flatnonzero(finite)
+        return positions[lttb(x[finite], y[finite], n_out)]
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    every = (n - 2) / (n_out - 2)
+    bounds = (np.arange(n_out - 1) * every).astype(int) + 1
+    kept = np.empty(n_out, dtype=int)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = bounds[i], bounds[i + 1]
+        next_lo, next_hi = (bounds[i + 1], bounds[i + 2]) if i + 2 < len(bounds) else (n - 1, n)
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        kept[i + 1] = a
+    return kept
+
+def resample_mean(rows, by, time, column, frequency):
+    # Mean of column per group and calendar period ('D', 'W', ...), labelled by period start
+    periods = rows[time].dt.to_period(frequency).dt.start_time
+    return (rows
+            .groupby([rows[by], periods], observed=True, sort=True)[column]
+            .mean()
+            .reset_index()
+            )
+
+def linear_trend(rows, by, x, y):
+    # Per-group least-squares line through (x, y), returned as its two endpoints.
+    # The normal equations are solved for every group at once from bincount sums;
+    # a missing value would turn its group's sums into NaN, so those rows are left out.
+    rows = rows[rows[x].notna() & rows[y].notna()]
+    codes, groups = pd.factorize(rows[by], sort=True)
+    xs = rows[x].to_numpy(dtype='datetime64[ns]').astype(np.int64).astype(float)
+    ys = rows[y].to_numpy(dtype=float)
+    origin = xs.mean() if len(xs) else 0.0
+    xs = xs - origin
+
+    n = np.bincount(codes, minlength=len(groups))
+    sx = np.bincount(codes, xs, minlength=len(groups))
+    sy = np.bincount(codes, ys, minlength=len(groups))
+    sxx = np.bincount(codes, xs * xs, minlength=len(groups))
+    sxy = np.bincount(codes, xs * ys, minlength=len(groups))
+    denominator = n * sxx - sx * sx
+    fitted = denominator > 0
+    slope = np.divide(n * sxy - sx * sy, denominator, out=np.zeros(len(groups)), where=fitted)
+    intercept = np.divide(sy - slope * sx, n, out=np.zeros(len(groups)), where=n > 0)
+
+    x_min = pd.Series(xs).groupby(codes).min().to_numpy()
+    x_max = pd.Series(xs).groupby(codes).max().to_numpy()
+    ends = pd.DataFrame({
+        by: np.repeat(groups[fitted], 2),
+        x: np.column_stack([x_min[fitted], x_max[fitted]]).ravel(),
+    })
+    ends[y] = np.repeat(intercept[fitted], 2) + np.repeat(slope[fitted], 2) * ends[x]
+    ends[x] = pd.to_datetime(ends[x] + origin)
+    return ends
+
+def trend_points(rows, by, time, column, frequency='D', point_budget=2000):
+    # Downsample a scatter to per-period means, then to at most point_budget
+    # points shared between the groups with LTTB. Rows without a value are
+    # dropped first, so no period or kept point is NaN.
+    rows = rows[rows[column].notna()]
+    if frequency:
+        points = resample_mean(rows, by, time, column, frequency)
+    else:
+        points = rows[[by, time, column]].sort_values([by, time])
+    if not point_budget or points.empty:
+        return points
+
+    per_group = max(point_budget // points[by].nunique(), 3)
+    kept = []
+    for _, group in points.groupby(by, observed=True, sort=False):
+        x = group[time].to_numpy(dtype='datetime64[ns]').astype(np.int64).astype(float)
+        kept.append(group.iloc[lttb(x, group[column].to_numpy(dtype=float), per_group)])
+    return pd.concat(kept, ignore_index=True)
+
+def percentile_of(statistic):
+    # 'p90' -> 0.9, anything else -> None
+    if statistic.startswith('p') and statistic[1:].replace('.', '', 1).isdigit():
+        return float(statistic[1:]) / 100
+    return None
+
+def group_statistics(rows, by, column, statistics=('min', 'mean', 'max', 'count'), first=()):
+    # Per-group statistics of column from a single sort of (group, value).
+    # Order statistics (min, max, percentiles) index into the sorted runs and the
+    # moments are segment sums, so adding statistics adds no passes over the rows.
+    codes, groups = pd.factorize(rows[by], sort=True)
+    values = rows[column].to_numpy(dtype=float)
+    order = np.lexsort((values, codes))
+    values = values[order]
+    counts = np.bincount(codes, minlength=len(groups))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int)
+    # NaN sorts to the end of each run and is skipped, as in pandas: statistics
+    # use the first n values of a run, n being its count of non-null values
+    missing = np.isnan(values)
+    n = counts - np.bincount(codes[order][missing], minlength=len(groups))
+    present = n > 0
+    last = np.where(present, starts + n - 1, starts)
+
+    result = pd.DataFrame(index=pd.Index(groups, name=by))
+    if len(groups) == 0:
+        return result.assign(**{statistic: pd.Series(dtype=float) for statistic in statistics},
+                             **{name: pd.Series(dtype=object) for name in first})
+
+    filled = np.where(missing, 0.0, values)
+    sums = np.add.reduceat(filled, starts)
+    means = np.divide(sums, n, out=np.full(len(groups), np.nan), where=present)
+    for statistic in statistics:
+        q = percentile_of(statistic)
+        if statistic == 'count':
+            result[statistic] = n
+        elif statistic == 'sum':
+            result[statistic] = sums
+        elif statistic == 'mean':
+            result[statistic] = means
+        elif statistic == 'min':
+            result[statistic] = np.where(present, values[starts], np.nan)
+        elif statistic == 'max':
+            result[statistic] = np.where(present, values[last], np.nan)
+        elif statistic == 'std':
+            deviations = np.where(missing, 0.0, filled - np.repeat(means, counts))
+            squares = np.add.reduceat(deviations ** 2, starts)
+            result[statistic] = np.sqrt(np.divide(squares, n - 1,
+                                                  out=np.full(len(groups), np.nan), where=n > 1))
+        elif q is not None:
+            # Linear interpolation between the closest ranks, as in pandas' quantile
+            position = starts + q * np.maximum(n - 1, 0)
+            lower = np.floor(position).astype(int)
+            upper = np.ceil(position).astype(int)
+            result[statistic] = np.where(present, values[lower] + (values[upper] - values[lower]) * (position - lower),
+                                         np.nan)
+        else:
+            raise ValueError(f"Unknown statistic: {statistic}")
+
+    # The first value of other columns in the original row order of each group
+    first_rows = np.minimum.reduceat(order, starts)
+    for name in first:
+        result[name] = rows[name].to_numpy()[first_rows]
+    return result
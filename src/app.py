@@ -1,24 +1,165 @@
-from dash import Dash
-import dash_bootstrap_components as dbc
-from data import load_data
-from components import get_layout
-from callbacks import register_callbacks
-
-# Create a Dash application
-app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
-app.title = "Pollution Tracker"
-
-# Load data
-data = load_data()
-
-# Setup the layout using components from components.py
-app.layout = get_layout(data)
-
-# Register callbacks to manage interactivity
-register_callbacks(app, data)
-
-# Server variable for deploying
-server = app.server
-
-if __name__ == '__main__':
-    app.run_server(debug=True)
+import time
+started = time.perf_counter()
+
+import hmac
+import logging
+import os
+import threading
+from dash import Dash, DiskcacheManager
+import dash_bootstrap_components as dbc
+from flask import Response, abort, jsonify, request, stream_with_context
+from dataset import DatasetHandle
+from components import DEFAULT_FILTERS, InitialLayout
+from callbacks import charting, register_callbacks
+from cache import ResultCache
+from metrics import CallbackMetrics, StartupTimer
+from encoding import use_encoder
+from export import EXPORT_FORMATS, export_filename, parse_filters, stream_export
+from geo import load_geometry
+from backends import make_backend
+
+# Create a Dash application
+app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
+app.title = "Pollution Tracker"
+
+# Responses, cached results and the layout are encoded with Dash's standard
+# JSON path unless POLLUTION_TRACKER_JSON_ENCODER=orjson selects the fast one
+use_encoder(os.environ.get('POLLUTION_TRACKER_JSON_ENCODER', 'json'))
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Start-up is timed per phase. Everything at module level is safe to run in a
+# preloading gunicorn master (see gunicorn.conf.py); warm() covers the rest.
+startup = StartupTimer(started)
+startup.mark('imports')
+
+# Callbacks query through the pandas reference backend or DuckDB
+backend = os.environ.get('POLLUTION_TRACKER_BACKEND', 'pandas')
+
+# Load data; with POLLUTION_TRACKER_RELOAD_INTERVAL set, each worker checks the
+# data files that often and swaps in a new version without a restart. The
+# watcher thread is started by warm(), after the fork.
+dataset = DatasetHandle(
+    lambda data: make_backend(backend, data),
+    poll_interval=float(os.environ['POLLUTION_TRACKER_RELOAD_INTERVAL']) if 'POLLUTION_TRACKER_RELOAD_INTERVAL' in os.environ else None,
+)
+data = dataset.view.data
+startup.mark('data')
+memory = data.memory_usage()
+logger.info("Loaded %d rows using %.1f MB:\n%s", len(data), memory.sum() / 2**20,
+            (memory / 2**20).round(2).to_string())
+
+# With POLLUTION_TRACKER_JOBS_DIR set, the map callback runs as a
+# background job in its own process, tracked in a diskcache there
+jobs_dir = os.environ.get('POLLUTION_TRACKER_JOBS_DIR')
+background_manager = None
+if jobs_dir:
+    import diskcache
+    background_manager = DiskcacheManager(diskcache.Cache(os.path.join(jobs_dir, 'jobs')))
+
+# Cache figure and table outputs; set POLLUTION_TRACKER_CACHE_DIR to share them across workers.
+# Results computed in background jobs only outlive the job on disk, so jobs imply a disk cache.
+cache = ResultCache(
+    max_bytes=int(os.environ.get('POLLUTION_TRACKER_CACHE_MB', 64)) * 2**20,
+    ttl=float(os.environ['POLLUTION_TRACKER_CACHE_TTL']) if 'POLLUTION_TRACKER_CACHE_TTL' in os.environ else None,
+    directory=os.environ.get('POLLUTION_TRACKER_CACHE_DIR') or (os.path.join(jobs_dir, 'results') if jobs_dir else None),
+)
+
+# Per-callback latency, payload and cache histograms for /metrics. With
+# POLLUTION_TRACKER_PROFILE_DIR set, a request sent with an X-Profile header
+# also writes a cProfile dump of each callback it runs to that directory.
+metrics = CallbackMetrics(profile_dir=os.environ.get('POLLUTION_TRACKER_PROFILE_DIR'))
+
+# Trend chart points are averaged per day ('D') or week ('W'), or left as 'raw'
+trend_frequency = os.environ.get('POLLUTION_TRACKER_TREND_FREQUENCY', 'D')
+
+# Register callbacks to manage interactivity
+initial_outputs = register_callbacks(
+    app, dataset, cache,
+    trend_frequency=None if trend_frequency == 'raw' else trend_frequency,
+    trend_point_budget=int(os.environ.get('POLLUTION_TRACKER_TREND_POINTS', 2000)),
+    summary_statistics=os.environ.get('POLLUTION_TRACKER_SUMMARY_STATS', 'min,mean,max,count').split(','),
+    background_manager=background_manager,
+    metrics=metrics,
+)
+startup.mark('callbacks')
+
+# The world outlines go into every initial layout
+load_geometry('world')
+startup.mark('geometry')
+
+# Setup the layout using components from components.py, with the default
+# view precomputed so a new session starts without any callback round trips
+initial_layout = InitialLayout(dataset, initial_outputs)
+app.validation_layout = initial_layout.skeleton()
+app.layout = initial_layout
+
+# Server variable for deploying
+server = app.server
+logger.info("Started in %s", startup.report())
+
+def warm():
+    # Starts the data watcher and the chart runtime and builds the initial
+    # layout. This cannot happen before a fork, so each worker does it before
+    # taking requests; otherwise the first layout request builds the layout.
+    startup.resume()
+    dataset.start_watching()
+    charting()
+    startup.mark('charts')
+    initial_layout.build()
+    startup.mark('layout')
+    logger.info("Worker %d warmed up in %s", os.getpid(), startup.report())
+
+@server.before_request
+def serve_initial_layout():
+    # The layout is served as JSON serialized once per data version
+    if request.path == f"{app.config.routes_pathname_prefix}_dash-layout":
+        return Response(initial_layout.serialized(), mimetype='application/json')
+
+# Reload trigger for deploy scripts, enabled by setting POLLUTION_TRACKER_ADMIN_TOKEN.
+# It reloads the worker that receives it; the others follow on their next poll.
+@server.route('/admin/reload', methods=['POST'])
+def reload_data():
+    token = os.environ.get('POLLUTION_TRACKER_ADMIN_TOKEN')
+    if not token or not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token):
+        abort(404)
+    dataset.reload_in_background()
+    return jsonify(version=dataset.current().version), 202
+
+# Each worker streams at most this many exports at once, so its other threads
+# stay free for the dashboard; further exports are turned away until one ends
+export_slots = threading.BoundedSemaphore(int(os.environ.get('POLLUTION_TRACKER_EXPORT_SLOTS', 1)))
+
+@server.route('/export')
+def export_measurements():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        abort(400, description=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    try:
+        filters = parse_filters(request.args, DEFAULT_FILTERS)
+    except ValueError as error:
+        abort(400, description=str(error))
+    # The export reads one version of the data even if a reload swaps it meanwhile
+    data = dataset.view.data
+    if filters['pollutant'] not in data.pollutants:
+        abort(400, description=f"pollutant must be one of {', '.join(data.pollutants)}")
+    if not export_slots.acquire(blocking=False):
+        return Response('An export is already running on this worker, retry shortly\n', status=429,
+                        headers={'Retry-After': '5'}, mimetype='text/plain')
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    response = Response(stream_with_context(stream_export(data, fmt, filters)), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{export_filename(filters, extension)}"'})
+    # Runs once the response is closed, whether it finished or the client went away
+    response.call_on_close(export_slots.release)
+    return response
+
+@server.route('/metrics')
+def callback_metrics():
+    gauges = {f'cache_{name}': value for name, value in cache.stats().items()}
+    gauges.update(startup.gauges())
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+if __name__ == '__main__':
+    dataset.start_watching()
+    app.run_server(debug=True)
@@ -0,0 +1,247 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import pandas as pd
+import pyarrow as pa
+
+from data import AQI_CATEGORIES, DATA_PATH, MEASUREMENT_SCHEMA, UPDATES_PATH, read_manifest, update_files
+from forks import reset_in_child
+from stations import StationIndex, station_totals
+
+class PandasBackend:
+    # Reference implementation: the monthly cube and sorted row slices held in pandas
+    def __init__(self, data):
+        self.data = data
+
+    def totals(self, pollutant, start_month, end_month, continents=None, countries=None):
+        return self.data.totals(pollutant, start_month, end_month,
+                                continents=continents, countries=countries)
+
+    def top_countries(self, pollutant, start_month, end_month, continents=None, n=15):
+        totals = self.totals(pollutant, start_month, end_month, continents=continents)
+        return totals.sort_values(by='value_mean', ascending=False).head(n)
+
+    def slice(self, pollutant, start_month, end_month, continents=None, countries=None):
+        return self.data.slice(pollutant, start_month, end_month,
+                               continents=continents, countries=countries)
+
+class DuckDbBackend:
+    # Runs the dashboard queries as parameterized SQL on DuckDB, either over the
+    # memory-mapped Arrow snapshot or directly over the parquet files, where
+    # DuckDB pushes the pollutant and month predicates down into the scan
+    FILTER = """
+        pollutant = $pollutant
+        AND month BETWEEN $start_month AND $end_month
+        AND ($continents IS NULL OR list_contains($continents, continent))
+        AND ($countries IS NULL OR list_contains($countries, countryname))
+    """
+
+    def __init__(self, source=(DATA_PATH,)):
+        import duckdb
+
+        self.connection = duckdb.connect()
+        self.local = threading.local()
+        self.arrow = source if isinstance(source, pa.Table) else None
+        if self.arrow is not None:
+            self.connection.register('arrow_measurements', self.arrow)
+            relation = 'arrow_measurements'
+        else:
+            # Update batches take their pollutant from the hive partition path
+            path, *updates = source
+            columns = ', '.join(MEASUREMENT_SCHEMA.names)
+            scans = [f"SELECT {columns} FROM read_parquet('{path}')"]
+            if updates:
+                files = ', '.join(f"'{file}'" for file in updates)
+                scans.append(f"SELECT {columns} FROM read_parquet([{files}], hive_partitioning = true)")
+            relation = f"""(
+                SELECT *, CAST(year(time) * 12 + month(time) - 1 AS INTEGER) AS month
+                FROM ({' UNION ALL BY NAME '.join(scans)})
+            )"""
+        # NaN readings count as missing, as they do in pandas aggregations
+        self.connection.execute(f"""
+            CREATE VIEW measurements AS
+            SELECT * REPLACE (
+                CASE WHEN isnan(value) THEN NULL ELSE value END AS value,
+                CASE WHEN isnan(AQI) THEN NULL ELSE AQI END AS AQI
+            )
+            FROM {relation}
+        """)
+
+        # The mode picks the first category in severity order among those with the
+        # highest count, matching mode_of_counts in the pandas backend
+        counts = ',\n'.join(
+            f"count(*) FILTER (WHERE AQI_cat = '{category}') AS \"{category}\""
+            for category in AQI_CATEGORIES
+            )
+        mode = ' '.join(f"WHEN \"{category}\" THEN '{category}'" for category in AQI_CATEGORIES)
+        greatest = ', '.join(f'"{category}"' for category in AQI_CATEGORIES)
+        self.totals_query = f"""
+            WITH totals AS (
+                SELECT
+                    countryname,
+                    first(continent) AS continent,
+                    count(value) AS count,
+                    coalesce(sum(value), 0) AS value_sum,
+                    min(value) AS value_min,
+                    max(value) AS value_max,
+                    coalesce(sum(AQI), 0) AS AQI_sum,
+                    count(AQI) AS AQI_count,
+                    min(AQI) AS AQI_min,
+                    max(AQI) AS AQI_max,
+                    first(unit) AS unit,
+                    {counts}
+                FROM measurements
+                WHERE {self.FILTER}
+                GROUP BY countryname
+            )
+            SELECT
+                *,
+                value_sum / nullif(count, 0) AS value_mean,
+                -- Over the readings with an AQI, NULL when there are none, as in query_cube
+                AQI_sum / nullif(AQI_count, 0) AS AQI_mean,
+                CASE greatest({greatest}) {mode} END AS AQI_cat
+            FROM totals
+        """
+        self.slice_query = f"""
+            SELECT * EXCLUDE (month)
+            FROM measurements
+            WHERE {self.FILTER}
+            ORDER BY pollutant, time
+        """
+
+    def cursor(self):
+        # DuckDB connections are not shared between threads; each thread gets a cursor
+        if not hasattr(self.local, 'cursor'):
+            cursor = self.connection.cursor()
+            # Registered Arrow tables are visible only to the cursor that registered them
+            if self.arrow is not None:
+                cursor.register('arrow_measurements', self.arrow)
+            self.local.cursor = cursor
+        return self.local.cursor
+
+    def execute(self, query, pollutant, start_month, end_month, continents=None, countries=None):
+        parameters = {
+            'pollutant': pollutant,
+            'start_month': start_month,
+            'end_month': end_month,
+            'continents': list(continents) if continents else None,
+            'countries': list(countries) if countries else None,
+        }
+        return self.cursor().execute(query, parameters).df()
+
+    def totals(self, pollutant, start_month, end_month, continents=None, countries=None):
+        totals = self.execute(self.totals_query + 'ORDER BY continent, countryname',
+                              pollutant, start_month, end_month, continents, countries)
+        return self.as_totals(totals)
+
+    def top_countries(self, pollutant, start_month, end_month, continents=None, n=15):
+        totals = self.execute(self.totals_query + f'ORDER BY value_mean DESC LIMIT {int(n)}',
+                              pollutant, start_month, end_month, continents)
+        return self.as_totals(totals)
+
+    def slice(self, pollutant, start_month, end_month, continents=None, countries=None):
+        return self.execute(self.slice_query, pollutant, start_month, end_month, continents, countries)
+
+    def as_totals(self, totals):
+        totals['AQI_cat'] = pd.Categorical(totals['AQI_cat'], categories=AQI_CATEGORIES, ordered=True)
+        return totals.set_index('countryname')
+
+class SharedFilter:
+    # The filter stage shared by the callbacks: per-country totals are computed
+    # once per pollutant and date range, and the region, country and top-n
+    # variants are row subsets of them. The callbacks fired by one filter change
+    # therefore cost a single query. A callback asking for a key that is being
+    # computed waits on that computation's future instead of repeating it; the
+    # lock only guards the dicts, so other keys are computed meanwhile.
+    def __init__(self, backend, max_entries=64):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        reset_in_child(self)
+
+    def after_fork(self):
+        # The threads computing the pending keys do not exist in the child
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.pending = {}
+
+    def cached(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            future = self.pending.get(key)
+            owner = future is None
+            if owner:
+                future = self.pending[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as error:
+            with self.lock:
+                self.pending.pop(key, None)
+            future.set_exception(error)
+            raise
+        with self.lock:
+            # A clear() while computing drops the pending key, and the value with it
+            if self.pending.get(key) is future:
+                del self.pending[key]
+                self.entries[key] = value
+                if len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def period_totals(self, pollutant, start_month, end_month):
+        return self.cached((pollutant, start_month, end_month),
+                           lambda: self.backend.totals(pollutant, start_month, end_month))
+
+    def station_index(self, pollutant, start_month, end_month, continents=None):
+        # Per-station totals of a period with a spatial index over them, built
+        # once per period and set of regions; panning the station map only queries it
+        continents = tuple(sorted(continents)) if continents else ()
+
+        def build():
+            rows = self.backend.slice(pollutant, start_month, end_month, continents=list(continents) or None)
+            return StationIndex(station_totals(rows))
+        return self.cached(('stations', pollutant, start_month, end_month, continents), build)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.pending.clear()
+
+    def totals(self, pollutant, start_month, end_month, continents=None, countries=None):
+        # Regions and countries select whole countries, so filtering the totals
+        # gives the same rows as filtering the measurements
+        totals = self.period_totals(pollutant, start_month, end_month)
+        if continents:
+            totals = totals[totals['continent'].isin(continents)]
+        if countries:
+            totals = totals[totals.index.isin(countries)]
+        return totals
+
+    def top_countries(self, pollutant, start_month, end_month, continents=None, n=15):
+        totals = self.totals(pollutant, start_month, end_month, continents=continents)
+        return totals.sort_values(by='value_mean', ascending=False).head(n)
+
+    def slice(self, pollutant, start_month, end_month, continents=None, countries=None):
+        return self.backend.slice(pollutant, start_month, end_month,
+                                  continents=continents, countries=countries)
+
+BACKENDS = {
+    'pandas': lambda data: PandasBackend(data),
+    'duckdb': lambda data: DuckDbBackend(data.arrow_table()),
+    'duckdb-parquet': lambda data: DuckDbBackend([DATA_PATH] + update_files(
+        UPDATES_PATH, [batch for batch in read_manifest(UPDATES_PATH)['batches'] if batch['version'] <= data.version])),
+}
+
+def make_backend(name, data):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown query backend {name!r}; expected one of {', '.join(BACKENDS)}")
+    return SharedFilter(BACKENDS[name](data))
@@ -0,0 +1,319 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from aggregate import category_mode, linear_trend, trend_points
+from backends import make_backend
+from cache import ResultCache
+from data import AQI_CATEGORIES, DATA_PATH, MEASUREMENT_SCHEMA, load_data, month_ordinal
+from dataset import DatasetHandle
+from encoding import CODECS
+from metrics import PHASES, CallbackMetrics
+from preprocess import compute_aqi
+
+BENCHMARK_DIR = '../data/benchmark'
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+# Filter states replayed against every dataset: the default view, a narrower
+# window for one region, and a single month for two regions
+SCENARIOS = [
+    ('PM2.5', 2014, 1, 2024, 12, None),
+    ('PM10', 2022, 1, 2023, 12, ['Europe']),
+    ('NO2', 2023, 5, 2023, 5, ['Asia', 'Africa']),
+]
+
+# Callbacks in the order one filter change triggers them in the browser
+CALLBACKS = ['update_region_options', 'update_country_options', 'display_choropleth',
+             'display_stations', 'plot_bar', 'plot_line', 'summary']
+
+def synthetic_data(n_rows, n_countries=111, seed=0):
+    rng = np.random.default_rng(seed)
+    countries = pd.Categorical.from_codes(
+        rng.integers(0, n_countries, n_rows),
+        categories=[f'Country {i}' for i in range(n_countries)]
+        )
+    categories = pd.Categorical.from_codes(
+        rng.integers(0, len(AQI_CATEGORIES), n_rows),
+        dtype=pd.CategoricalDtype(AQI_CATEGORIES, ordered=True)
+        )
+    return pd.DataFrame({'countryname': countries, 'AQI_cat': categories})
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def lambda_mode(data):
+    # The per-group lambda the callbacks used before category_mode
+    return (data
+            .assign(AQI_cat=data['AQI_cat'].astype(str))
+            .groupby('countryname', observed=True)['AQI_cat']
+            .agg(lambda x: pd.Series.mode(x)[0])
+            )
+
+def bench_mode(n_rows):
+    data = synthetic_data(n_rows)
+    _, lambda_seconds = timed(lambda_mode, data)
+    _, vectorized_seconds = timed(category_mode, data, 'countryname')
+    print(f"AQI category mode over {n_rows:,} rows")
+    print(f"  groupby + lambda: {lambda_seconds:8.3f} s")
+    print(f"  category_mode:    {vectorized_seconds:8.3f} s")
+    print(f"  speedup:          {lambda_seconds / vectorized_seconds:8.1f}x")
+
+def scaled_measurements(scale, path=DATA_PATH, seed=0):
+    # The real measurements repeated scale times as distinct stations, with each
+    # copy's values jittered and its AQI recomputed, so the countries, pollutants
+    # and date range stay realistic while the row count grows
+    rng = np.random.default_rng(seed)
+    base = pq.read_table(path).select(MEASUREMENT_SCHEMA.names).to_pandas(date_as_object=False)
+    for copy in range(scale):
+        chunk = base.copy()
+        if copy:
+            chunk['coordinates'] = chunk['coordinates'].astype(str) + f' #{copy}'
+            chunk['value'] = chunk['value'] * rng.lognormal(0, 0.25, len(chunk))
+            aqi, categories = compute_aqi(chunk['pollutant'], chunk['value'])
+            chunk['AQI'] = aqi
+            chunk['AQI_cat'] = np.array(AQI_CATEGORIES + [None], dtype=object)[categories]
+        yield pa.Table.from_pandas(chunk, schema=MEASUREMENT_SCHEMA, preserve_index=False)
+
+def write_scaled(scale, directory=BENCHMARK_DIR):
+    path = os.path.join(directory, f'scale-{scale}.parquet')
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        partial = f"{path}.partial"
+        with pq.ParquetWriter(partial, MEASUREMENT_SCHEMA) as writer:
+            for table in scaled_measurements(scale):
+                writer.write_table(table)
+        os.replace(partial, path)
+    return path
+
+class StubApp:
+    # Collects the server callbacks so they can be called directly, without Dash
+    def __init__(self):
+        self.callbacks = {}
+
+    def callback(self, *args, **kwargs):
+        def decorator(func):
+            self.callbacks[func.__name__] = func
+            return func
+        return decorator
+
+    def clientside_callback(self, *args, **kwargs):
+        pass
+
+class RecordingMetrics(CallbackMetrics):
+    # Keeps the phase breakdown of the most recent call, with 0 for phases it did not run
+    def observe(self, name, elapsed, record):
+        super().observe(name, elapsed, record)
+        self.last = dict(dict.fromkeys(PHASES, 0.0), **record['phases'], total=elapsed, bytes=record['bytes'])
+
+def replay(callbacks, dataset, pollutant, start_year, start_month, end_year, end_month, regions):
+    # One filter change: each output is computed from the same inputs the browser
+    # would send, and the trend and summary follow the bar chart's first country
+    # as they do through first_country_name
+    dates = (start_year, start_month, end_year, end_month)
+    calls = {
+        'update_region_options': lambda: callbacks['update_region_options'](pollutant, *dates),
+        'update_country_options': lambda: callbacks['update_country_options'](pollutant, *dates, regions),
+        'display_choropleth': lambda: callbacks['display_choropleth'](pollutant, regions, *dates, 'world'),
+        'display_stations': lambda: callbacks['display_stations'](pollutant, regions, *dates, None),
+        'plot_bar': lambda: callbacks['plot_bar'](pollutant, *dates, regions),
+        'plot_line': lambda: callbacks['plot_line'](pollutant, [first_country], *dates),
+        'summary': lambda: callbacks['summary'](pollutant, [first_country], *dates),
+    }
+    dataset.current().backend.clear()
+    first_country = None
+    for name in CALLBACKS:
+        yield name, calls[name]
+        if name == 'plot_bar':
+            first_country = callbacks['plot_bar'](pollutant, *dates, regions)[1]
+
+def bench_callbacks(scale, repeat=3, backend='pandas'):
+    from callbacks import register_callbacks
+
+    path = write_scaled(scale)
+    started = time.perf_counter()
+    dataset = DatasetHandle(lambda data: make_backend(backend, data), path=path,
+                            snapshot_path=path.replace('.parquet', '.arrow'), updates_path=None)
+    load_seconds = time.perf_counter() - started
+
+    app = StubApp()
+    metrics = RecordingMetrics()
+    # A zero-byte result cache stores nothing, so every call is computed and serialized
+    register_callbacks(app, dataset, ResultCache(max_bytes=0), metrics=metrics)
+
+    runs = {name: [] for name in CALLBACKS}
+    for _ in range(repeat):
+        for scenario in SCENARIOS:
+            for name, call in replay(app.callbacks, dataset, *scenario):
+                call()
+                runs[name].append(metrics.last)
+
+    # Peak memory is measured in a separate pass, as tracing slows every allocation
+    peaks = {name: 0 for name in CALLBACKS}
+    for scenario in SCENARIOS:
+        for name, call in replay(app.callbacks, dataset, *scenario):
+            tracemalloc.start()
+            call()
+            peaks[name] = max(peaks[name], tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+    results = {}
+    for name in CALLBACKS:
+        results[name] = {
+            key: statistics.median(run[key] for run in runs[name])
+            for key in ('total',) + PHASES
+            }
+        results[name]['peak_bytes'] = peaks[name]
+        results[name]['output_bytes'] = max(run['bytes'] for run in runs[name])
+    return {'rows': len(dataset.current().data), 'load_seconds': load_seconds, 'callbacks': results}
+
+def bench_encoding(scale, repeat=5, backend='pandas'):
+    # Encodes the output of every callback with each JSON encoder, as Dash
+    # would encode the response, and checks that they decode to the same value
+    from callbacks import register_callbacks
+    from components import DEFAULT_FILTERS, get_layout
+
+    path = write_scaled(scale)
+    dataset = DatasetHandle(lambda data: make_backend(backend, data), path=path,
+                            snapshot_path=path.replace('.parquet', '.arrow'), updates_path=None)
+    app = StubApp()
+    initial_outputs = register_callbacks(app, dataset, ResultCache(max_bytes=0))
+
+    # The initial layout, with the map geometry and both specs, is the largest response
+    names = CALLBACKS + ['layout']
+    results = {name: {encoder: {'seconds': [], 'bytes': 0} for encoder in CODECS} for name in names}
+    matches = {name: True for name in names}
+
+    def measure(name, output):
+        decoded = []
+        for encoder, (dumps, loads) in CODECS.items():
+            for _ in range(repeat):
+                text, seconds = timed(dumps, output)
+                results[name][encoder]['seconds'].append(seconds)
+            results[name][encoder]['bytes'] = max(results[name][encoder]['bytes'], len(text.encode()))
+            decoded.append(loads(text))
+        matches[name] &= all(value == decoded[0] for value in decoded[1:])
+
+    for scenario in SCENARIOS:
+        for name, call in replay(app.callbacks, dataset, *scenario):
+            measure(name, call())
+    measure('layout', get_layout(initial_outputs(**DEFAULT_FILTERS)))
+
+    print(f"{scale}x scale, median encode time and largest output per encoder")
+    print(f"  {'callback':24} " + ' '.join(f"{encoder + ' ms':>10} {encoder + ' KB':>10}" for encoder in CODECS)
+          + f" {'same':>5}")
+    for name, encoders in results.items():
+        print(f"  {name:24} "
+              + ' '.join(f"{statistics.median(stats['seconds']) * 1e3:10.2f} {stats['bytes'] / 2**10:10.1f}"
+                         for stats in encoders.values())
+              + f" {'yes' if matches[name] else 'NO':>5}")
+
+def trend_failures(pollutants=None):
+    # Checks the trend chart data over the whole dataset: every point and line end
+    # is finite, and every country with readings on two dates gets a line. Most
+    # O3 and CO readings have no AQI, which once left their lines NaN.
+    data = load_data()
+    for pollutant in pollutants or data.pollutants:
+        rows = data.slice(pollutant, month_ordinal(2014, 1), month_ordinal(2024, 12))
+        points = trend_points(rows, 'countryname', 'time_hour', 'AQI')
+        ends = linear_trend(rows, 'countryname', 'time_hour', 'AQI')
+        if not np.isfinite(points['AQI']).all():
+            yield f"{pollutant}: {int(points['AQI'].isna().sum())} of {len(points)} trend points are not finite"
+        if not np.isfinite(ends['AQI']).all():
+            yield f"{pollutant}: trend lines of {ends.loc[~np.isfinite(ends['AQI']), 'countryname'].nunique()} countries are not finite"
+        dates = rows[rows['AQI'].notna()].groupby('countryname', observed=True)['time_hour'].nunique()
+        missing = set(dates[dates > 1].index) - set(ends['countryname'])
+        if missing:
+            yield f"{pollutant}: no trend line for {', '.join(sorted(missing))}"
+
+def print_results(scale, result):
+    print(f"{scale}x scale: {result['rows']:,} rows, loaded in {result['load_seconds']:.1f} s")
+    print(f"  {'callback':24} {'total ms':>9} " + ' '.join(f'{phase:>9}' for phase in PHASES)
+          + f" {'peak MB':>8} {'output KB':>10}")
+    for name, stats in result['callbacks'].items():
+        print(f"  {name:24} {stats['total'] * 1e3:9.1f} "
+              + ' '.join(f'{stats[phase] * 1e3:9.1f}' for phase in PHASES)
+              + f" {stats['peak_bytes'] / 2**20:8.1f} {stats['output_bytes'] / 2**10:10.1f}")
+
+def regressions(results, baseline, tolerance):
+    # Latency gets an absolute allowance too, as single milliseconds are noisy.
+    # Whatever the baseline has no figure for fails as well, since it cannot be checked.
+    for scale, result in results.items():
+        previous = baseline.get('scales', {}).get(scale)
+        if previous is None:
+            yield f"{scale}x: not in the baseline"
+            continue
+        for name, stats in result['callbacks'].items():
+            before = previous['callbacks'].get(name)
+            if before is None:
+                yield f"{scale}x {name}: not in the baseline"
+                continue
+            missing = [key for key in ('total',) + PHASES + ('peak_bytes', 'output_bytes') if key not in before]
+            if missing:
+                yield f"{scale}x {name} {', '.join(missing)}: not in the baseline"
+                continue
+            for key in ('total',) + PHASES:
+                if stats[key] > before[key] * tolerance + 0.005:
+                    yield f"{scale}x {name} {key}: {before[key] * 1e3:.1f} -> {stats[key] * 1e3:.1f} ms"
+            for key in ('peak_bytes', 'output_bytes'):
+                if stats[key] > before[key] * tolerance:
+                    yield f"{scale}x {name} {key}: {before[key]:,} -> {stats[key]:,}"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the dashboard data paths')
+    commands = parser.add_subparsers(dest='command', required=True)
+    mode = commands.add_parser('mode', help='AQI category mode, lambda against vectorized')
+    mode.add_argument('--rows', type=int, default=10_000_000)
+    callbacks = commands.add_parser('callbacks', help='Every data callback on scaled copies of the dataset')
+    callbacks.add_argument('--scales', type=int, nargs='+', default=[10, 100, 1000])
+    callbacks.add_argument('--repeat', type=int, default=3)
+    callbacks.add_argument('--backend', default='pandas')
+    callbacks.add_argument('--save', nargs='?', const=BASELINE_PATH, help='Write the results as the baseline')
+    callbacks.add_argument('--compare', nargs='?', const=BASELINE_PATH, help='Fail on regressions against a baseline')
+    callbacks.add_argument('--tolerance', type=float, default=1.25)
+    encoding = commands.add_parser('encoding', help='Encode time and size of every callback output per JSON encoder')
+    encoding.add_argument('--scales', type=int, nargs='+', default=[1, 10])
+    encoding.add_argument('--repeat', type=int, default=5)
+    encoding.add_argument('--backend', default='pandas')
+    trends = commands.add_parser('trends', help='Fail if the trend chart gets NaN points or lines on the dataset')
+    trends.add_argument('--pollutants', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'mode':
+        bench_mode(args.rows)
+    elif args.command == 'trends':
+        found = list(trend_failures(args.pollutants))
+        for failure in found:
+            print(f"Trend check failed: {failure}")
+        if found:
+            raise SystemExit(1)
+        print("Trend points and lines are finite")
+    elif args.command == 'encoding':
+        for scale in args.scales:
+            bench_encoding(scale, args.repeat, args.backend)
+    else:
+        results = {}
+        for scale in args.scales:
+            results[str(scale)] = bench_callbacks(scale, args.repeat, args.backend)
+            print_results(scale, results[str(scale)])
+        if args.save:
+            with open(args.save, 'w', encoding='utf-8') as f:
+                json.dump({'backend': args.backend, 'python': platform.python_version(),
+                           'machine': platform.machine(), 'scales': results}, f, indent=1)
+        if args.compare:
+            with open(args.compare, 'r', encoding='utf-8') as f:
+                found = list(regressions(results, json.load(f), args.tolerance))
+            for regression in found:
+                print(f"Regression: {regression}")
+            if found:
+                raise SystemExit(1)
@@ -0,0 +1,152 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+from data import month_ordinal
+from encoding import dumps, loads
+from forks import reset_in_child
+from metrics import note_cache, phase
+
+def month_range_key(start_year, start_month, end_year, end_month):
+    return month_ordinal(start_year, start_month), month_ordinal(end_year, end_month)
+
+def unordered_key(values):
+    # Multi-select values whose order does not change the output (regions, map selection)
+    if not values:
+        return ()
+    if isinstance(values, str):
+        values = [values]
+    return tuple(sorted(values))
+
+def ordered_key(values):
+    # Multi-select values whose order matters (the first four countries are plotted)
+    if not values:
+        return ()
+    if isinstance(values, str):
+        values = [values]
+    return tuple(values)
+
+def viewport_key(viewport):
+    # Map bounds rounded to about 100 m, so a viewport moved by a fraction of a pixel reuses the entry
+    if not viewport:
+        return ()
+    return tuple(round(viewport[side], 3) for side in ('south', 'west', 'north', 'east'))
+
+class MemoryBackend:
+    # Per-process LRU bounded by the total size of the stored payloads
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        reset_in_child(self)
+
+    def after_fork(self):
+        # The entries may have been mid-update in the parent, so the child starts empty
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, payload = entry
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return payload
+
+    def set(self, key, payload):
+        if len(payload) > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (expires, payload)
+            self.size += len(payload)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.size, 'evictions': self.evictions}
+
+    def _remove(self, key):
+        _, payload = self.entries.pop(key)
+        self.size -= len(payload)
+
+class DiskBackend:
+    # SQLite-backed LRU in a directory that every gunicorn worker on the host can share
+    def __init__(self, directory, max_bytes, ttl=None):
+        import diskcache
+
+        self.ttl = ttl
+        self.store = diskcache.Cache(directory, size_limit=max_bytes,
+                                     eviction_policy='least-recently-used')
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, payload):
+        self.store.set(key, payload, expire=self.ttl)
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self):
+        return {'entries': len(self.store), 'bytes': self.store.volume()}
+
+class ResultCache:
+    # Caches the serialized output of figure and spec callbacks, keyed on the
+    # normalized filter state rather than the raw (unhashable) callback arguments
+    def __init__(self, max_bytes=64 * 2**20, ttl=None, directory=None):
+        if directory:
+            self.backend = DiskBackend(directory, max_bytes, ttl)
+        else:
+            self.backend = MemoryBackend(max_bytes, ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def memoize(self, name, key, version=None):
+        # version() names the data a result is computed from; it is read before
+        # the callback runs, so an entry never holds data older than its key
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args):
+                cache_key = (name,) + key(*args)
+                if version is not None:
+                    cache_key = (name, version()) + cache_key[1:]
+                payload = self.backend.get(cache_key)
+                if payload is not None:
+                    self.hits += 1
+                    note_cache(hit=True)
+                    with phase('serialize'):
+                        return loads(payload)
+
+                self.misses += 1
+                result = func(*args)
+                with phase('serialize'):
+                    payload = dumps(result)
+                note_cache(hit=False)
+                self.backend.set(cache_key, payload)
+                return result
+            return wrapper
+        return decorator
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, **self.backend.stats()}
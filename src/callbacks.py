@@ -1,19 +1,90 @@
+import functools
+import os
 import pandas as pd
-import plotly.express as px
-import altair as alt
-alt.data_transformers.enable("vegafusion")
+from dash import Patch
 from dash.dependencies import Input, Output, State
-import json
-import functools
-import vegafusion as vf
+from data import CATEGORY_COLORS, CUBE_STATISTICS, month_ordinal
+from geo import base_choropleth, geometry_subset, load_geometry
+from aggregate import group_statistics, linear_trend, percentile_of, trend_points
+from cache import ResultCache, month_range_key, ordered_key, unordered_key, viewport_key
+from metrics import CallbackMetrics, phase
+from specs import compact_spec, spec_skeleton
+from stations import WORLD_VIEWPORT, base_station_map, station_markers
+
+@functools.lru_cache()
+def chart_libraries():
+    # Altair and VegaFusion take about a second to import, so they are loaded
+    # with the first chart, or once in a preloading gunicorn master
+    import altair as alt
+    import vegafusion as vf
+    return alt, vf
+
+charting_pid = None
+
+def charting():
+    # The VegaFusion runtime hangs in a forked process, so it is configured in
+    # the process that draws the charts and never in a master before a fork
+    global charting_pid
+    alt, vf = chart_libraries()
+    if charting_pid != os.getpid():
+        alt.data_transformers.enable("vegafusion")
+        # Configure DuckDB connection
+        vf.runtime.set_connection("duckdb")
+        charting_pid = os.getpid()
+    return alt
+
+STATISTIC_LABELS = {
+    'min': 'Minimum',
+    'mean': 'Average',
+    'max': 'Maximum ',
+    'count': 'No. of Observations',
+    'std': 'Standard Deviation',
+}
+
+def statistic_label(statistic):
+    q = percentile_of(statistic)
+    if q is not None:
+        return f"{statistic[1:]}th Percentile"
+    return STATISTIC_LABELS[statistic]
 
-# Configure DuckDB connection
-vf.runtime.set_connection("duckdb")
+def map_values(totals):
+    # Per-country values of the choropleth trace
+    return {
+        'locations': totals.index.tolist(),
+        'z': totals['AQI_cat'].cat.codes.tolist(),
+        'text': totals['AQI_cat'].astype(str).tolist(),
+    }
+
+def register_callbacks(app, dataset, cache=None, trend_frequency='D', trend_point_budget=2000,
+                       summary_statistics=CUBE_STATISTICS, background_manager=None, metrics=None):
+    if cache is None:
+        cache = ResultCache()
+    if metrics is None:
+        metrics = CallbackMetrics()
+
+    # With a manager the map callback runs as a background job, so a slow query
+    # does not hold a request worker. When its inputs change while a job runs,
+    # the renderer asks for the stale job to be terminated. Jobs are forked
+    # processes, and the Vega compilers behind the Altair charts hang after a
+    # fork, so the charts stay in the request worker.
+    background = dict(background=True, manager=background_manager) if background_manager else {}
+
+    # Cached outputs are keyed on the data version, so a reload invalidates them
+    def version():
+        return dataset.current().version
 
-with open("../data/raw/custom.geo.json", "r", encoding="utf-8") as f:
-            countries_geojson = json.load(f)
+    # Everything in a chart spec but its data is the same for every filter value,
+    # so once the browser holds the spec only the data block is patched
+    skeletons = {}
+
+    def spec_update(name, spec):
+        skeleton = spec_skeleton(spec)
+        if skeletons.setdefault(name, skeleton) != skeleton:
+            return spec
+        update = Patch()
+        update['data'] = spec['data']
+        return update
 
-def register_callbacks(app, data):
     # Update country options based on filters
     @app.callback(
         Output('country_filter', 'options'),
@@ -24,24 +95,23 @@ def register_callbacks(app, data):
             Input("end_year", "value"),
             Input("end_month", "value"),
             Input("region_filter", "value"),
-        ]
+        ],
+        prevent_initial_call=True
     )
-    #@functools.lru_cache()
+    @metrics.instrument('update_country_options')
+    @cache.memoize('update_country_options', version=version, key=lambda pollutant, sy, sm, ey, em, regions: (
+        pollutant, *month_range_key(sy, sm, ey, em), unordered_key(regions)))
     def update_country_options(selected_pollutant, start_year, start_month, end_year, end_month, regions):
-        start_date_str = f"{start_year}-{start_month:02d}"
-        end_date_str = f"{end_year}-{end_month:02d}"
-        start_date = pd.to_datetime(start_date_str).date()
-        end_date = pd.to_datetime(end_date_str).date()
-
-        filtered_data = data.query(
-            "pollutant == @selected_pollutant and @start_date <= time <= @end_date"
-            )
-
-        if regions:
-            filtered_data = filtered_data[filtered_data['continent'].isin(regions)]
+        # Every query of a call goes to the version current when the call started
+        data = dataset.current().backend
+        with phase('filter'):
+            totals = data.totals(
+                selected_pollutant,
+                month_ordinal(start_year, start_month), month_ordinal(end_year, end_month),
+                continents=regions
+                )
 
-        unique_countries = filtered_data['countryname'].unique()
-        return [{'label': country, 'value': country} for country in unique_countries]
+        return [{'label': country, 'value': country} for country in totals.index]
     
     @app.callback(
         Output('region_filter', 'options'),
@@ -51,53 +121,59 @@ def register_callbacks(app, data):
         Input("start_month", "value"),
         Input("end_year", "value"),
         Input("end_month", "value"),
-        ]
+        ],
+        prevent_initial_call=True
     )
-    @functools.lru_cache()
+    @metrics.instrument('update_region_options')
+    @cache.memoize('update_region_options', version=version, key=lambda pollutant, sy, sm, ey, em: (
+        pollutant, *month_range_key(sy, sm, ey, em)))
     def update_region_options(selected_pollutant, start_year, start_month, end_year, end_month):
-        start_date_str = f"{start_year}-{start_month:02d}"
-        end_date_str = f"{end_year}-{end_month:02d}"
-        start_date = pd.to_datetime(start_date_str).date()
-        end_date = pd.to_datetime(end_date_str).date()
-
-        filtered_data = data.query(
-            "pollutant == @selected_pollutant and @start_date <= time <= @end_date"
-            )
+        data = dataset.current().backend
+        with phase('filter'):
+            totals = data.totals(
+                selected_pollutant,
+                month_ordinal(start_year, start_month), month_ordinal(end_year, end_month)
+                )
 
-        unique_continent = filtered_data['continent'].unique()
+        unique_continent = totals['continent'].unique()
         return [{'label': continent, 'value': continent} for continent in unique_continent]
 
-    @app.callback(
+    # Pure UI state is updated in the browser; these callbacks never reach the server
+    app.clientside_callback(
+        "function(first_country) { return first_country; }",
         Output('country_filter', 'value'),
-        [Input('first_country_name', 'children')]
+        Input('first_country_name', 'children'),
+        prevent_initial_call=True
     )
-    @functools.lru_cache()
-    def set_country_filter_default(first_country):
-        return first_country
-    
-    @app.callback(
+
+    app.clientside_callback(
+        "function(n, is_open) { return n ? !is_open : is_open; }",
         Output("collapse", "is_open"),
         Input("collapse-button", "n_clicks"),
         State("collapse", "is_open"),  # Pass the current "state" of the component (is it open or not)
+        prevent_initial_call=True
     )
-    @functools.lru_cache()
-    def toggle_collapse(n, is_open):
-        print(n)  # The number of times the button has been clicked
-        print(is_open)  # Whether the collapse is open or not
-        return not is_open if n else is_open
 
     # Display choropleth map based on selections
     @app.callback(
         Output("graph", "figure"), 
+        Output("map-geometry", "data"),
+        Output("map-locations", "data"),
         Input("pollutant_type_filter", "value"),
         Input("region_filter", "value"),
         Input("start_year", "value"),
         Input("start_month", "value"),
         Input("end_year", "value"),
         Input("end_month", "value"),
-        State('selected-countries', 'data')
+        State('map-geometry', 'data'),
+        prevent_initial_call=True,
+        **background
     )
-    def display_choropleth(selected_pollutant, regions, start_year, start_month, end_year, end_month, selected_countries):
+    @metrics.instrument('display_choropleth')
+    @cache.memoize('display_choropleth', version=version, key=lambda pollutant, regions, sy, sm, ey, em, level: (
+        pollutant, *month_range_key(sy, sm, ey, em), unordered_key(regions), level))
+    def display_choropleth(selected_pollutant, regions, start_year, start_month, end_year, end_month, current_level):
+        data = dataset.current().backend
         region_centers = {
         'Asia': {'lat': 34.0479, 'lon': 100.6197},
         'Europe': {'lat': 54.5260, 'lon': 15.2551},
@@ -107,131 +183,155 @@ def register_callbacks(app, data):
         'Australia': {'lat': -25.2744, 'lon': 133.7751}
     }
 
-        start_date_str = f"{start_year}-{start_month:02d}"
-        end_date_str = f"{end_year}-{end_month:02d}"
-        start_date = pd.to_datetime(start_date_str).date()
-        end_date = pd.to_datetime(end_date_str).date()
-        
-        filtered_data = data.query(
-            "pollutant == @selected_pollutant and @start_date <= time <= @end_date"
-            )
-
-        if regions:
-            filtered_data = filtered_data[filtered_data['continent'].isin(regions)]
-
-        aggregated_data = filtered_data.groupby('countryname')['AQI_cat'].agg(lambda x: pd.Series.mode(x)[0]).reset_index()
-        
-        category_color_scale = dict([
-            ('Good', '#98FB98'),  # Pale Green
-            ('Moderate', '#FFFF99'),  # Light Yellow
-            ('Unhealthy for Sensitive Groups', '#FFD700'),  # Gold
-            ('Unhealthy', '#FFA500'),  # Orange
-            ('Very Unhealthy', '#FF6347'),  # Tomato Red
-            ('Hazardous', '#B22222')  # Firebrick Red
-        ])
-        
-        map = px.choropleth(
-            aggregated_data,
-            geojson=countries_geojson,
-            locations='countryname',
-            color='AQI_cat',
-            featureidkey="properties.admin",
-            color_discrete_map=category_color_scale,
-            labels={'AQI_cat': "AQI Category", "countryname":'Country Name'},
-            category_orders={"AQI_cat": ["Good", "Moderate", "Unhealthy for Sensitive Groups", "Unhealthy", 'Very Unhealthy', 'Hazardous']}, 
-        )
+        with phase('filter'):
+            totals = data.totals(
+                selected_pollutant,
+                month_ordinal(start_year, start_month), month_ordinal(end_year, end_month),
+                continents=regions
+                )
+        countries = totals.index.tolist()
 
-        if regions and len(regions) == 0:
-            center = None
-            projection_scale = 1
-        elif regions and len(regions) == 1: 
+        if regions and len(regions) == 1: 
+            level = 'region'
             center = region_centers.get(regions[0], {'lat': 0, 'lon': 0})
             projection_scale = 1.5
         else:
+            level = 'world'
             center = {'lat': 0, 'lon': 0}
             projection_scale = 1
-                
-        map.update_layout(
-            geo=dict(
-                center = center,
-                projection_type = 'natural earth',
-                projection_scale = projection_scale
-            ),
-            margin={"r": 0, "t": 0, "l": 0, "b": 0},
-            clickmode='event+select',
-        )
 
-        for trace in map.data:
-            if any(loc in selected_countries for loc in trace.locations):
-                trace.marker.line.width = 2
-                trace.marker.line.color = 'silver'
-            else:
-                trace.marker.line.width = 0
+        # The base figure in the layout already carries the world geometry, so
+        # only the per-country values are sent unless the zoom level changes
+        map = Patch()
+        with phase('aggregate'):
+            values = map_values(totals)
+        for name, column in values.items():
+            map['data'][0][name] = column
+        # Selection outlines are redrawn by highlight_selected_countries once
+        # map-locations changes, so clear them rather than outline stale rows
+        map['data'][0]['marker']['line']['width'] = 0
+        with phase('figure'):
+            if level == 'region':
+                map['data'][0]['geojson'] = geometry_subset(level, countries)
+            elif current_level != level:
+                map['data'][0]['geojson'] = load_geometry(level)
+        map['layout']['geo']['center'] = center
+        map['layout']['geo']['projection_scale'] = projection_scale
 
-        return map
+        return map, level, countries
 
-    @app.callback(
+    # Outline the selected countries without re-filtering or rebuilding the map.
+    # Only the marker line widths change; the rest of the figure is reused as is.
+    app.clientside_callback(
+        """
+        function(selected_countries, countries, figure) {
+            const trace = figure.data[0];
+            const width = countries.map(country => selected_countries.includes(country) ? 2 : 0);
+            const marker = {...trace.marker, line: {...trace.marker.line, width: width}};
+            return {...figure, data: [{...trace, marker: marker}, ...figure.data.slice(1)]};
+        }
+        """,
+        Output("graph", "figure", allow_duplicate=True),
+        Input('selected-countries', 'data'),
+        Input('map-locations', 'data'),
+        State("graph", "figure"),
+        prevent_initial_call=True
+    )
+
+    app.clientside_callback(
+        """
+        function(clickData, selected_countries) {
+            if (!clickData) {
+                return selected_countries;
+            }
+            const country_name = clickData.points[0].location;
+            if (selected_countries.includes(country_name)) {
+                return selected_countries.filter(country => country !== country_name);
+            }
+            return [...selected_countries, country_name];
+        }
+        """,
         Output('selected-countries', 'data'),
-        [Input('graph', 'clickData')],
-        [State('selected-countries', 'data')]
+        Input('graph', 'clickData'),
+        State('selected-countries', 'data'),
+        prevent_initial_call=True
     )
-    def update_selected_countries(clickData, selected_countries):
-        if clickData:
-            country_name = clickData['points'][0]['location']
-            if country_name in selected_countries:
-                selected_countries.remove(country_name)
-            else:
-                selected_countries.append(country_name)
-        return selected_countries
 
-    # Update top countries chart
+    # The bounds of the station map after every pan or zoom, taken from the
+    # corners Plotly reports for the mapbox viewport
+    app.clientside_callback(
+        """
+        function(relayout) {
+            const derived = relayout && relayout['mapbox._derived'];
+            if (!derived) {
+                return window.dash_clientside.no_update;
+            }
+            const lons = derived.coordinates.map(corner => corner[0]);
+            const lats = derived.coordinates.map(corner => corner[1]);
+            return {south: Math.min(...lats), west: Math.min(...lons), north: Math.max(...lats), east: Math.max(...lons)};
+        }
+        """,
+        Output('station-viewport', 'data'),
+        Input('station-map', 'relayoutData'),
+        prevent_initial_call=True
+    )
+
+    def station_view(pollutant, regions, start_year, start_month, end_year, end_month, viewport):
+        # Stations of the period are indexed once; each viewport is a box query on
+        # the index, with the stations in view clustered when there are too many
+        data = dataset.current().backend
+        with phase('filter'):
+            index = data.station_index(pollutant, month_ordinal(start_year, start_month),
+                                       month_ordinal(end_year, end_month), continents=regions)
+        with phase('aggregate'):
+            return station_markers(index, **(viewport or WORLD_VIEWPORT))
+
     @app.callback(
-        Output("top_countries_chart", "spec"),
-        Output("first_country_name", "children"),
-        [
-            Input("pollutant_type_filter", "value"),
-            Input("start_year", "value"),
-            Input("start_month", "value"),
-            Input("end_year", "value"),
-            Input("end_month", "value"),
-            Input("region_filter", "value")
-        ]
+        Output('station-map', 'figure'),
+        Output('station-status', 'children'),
+        Input('pollutant_type_filter', 'value'),
+        Input('region_filter', 'value'),
+        Input('start_year', 'value'),
+        Input('start_month', 'value'),
+        Input('end_year', 'value'),
+        Input('end_month', 'value'),
+        Input('station-viewport', 'data'),
+        prevent_initial_call=True
     )
-    def plot_bar(pollutant, start_year, start_month, end_year, end_month, regions):
-        start_date_str = f"{start_year}-{start_month:02d}"
-        end_date_str = f"{end_year}-{end_month:02d}"
-        start_date = pd.to_datetime(start_date_str).date()
-        end_date = pd.to_datetime(end_date_str).date()
-
-        filtered_data = data[
-            (data['time'] >= start_date) &
-            (data['time'] <= end_date) &
-            (data['pollutant'] == pollutant)
-        ]
-
-        if regions:
-            filtered_data = filtered_data[filtered_data['continent'].isin(regions)]
-
-        aggregated_data = filtered_data.groupby('countryname').agg(
-            mean_value=pd.NamedAgg(column='value', aggfunc='mean'),
-            most_frequent_cat=pd.NamedAgg(column='AQI_cat', aggfunc=lambda x: pd.Series.mode(x).iloc[0])
-        ).reset_index()
-        
-        aggregated_data = aggregated_data.sort_values(by='mean_value', ascending=False).head(15)
-        
-        category_color_scale = dict([
-            ('Good', '#98FB98'),  # Pale Green
-            ('Moderate', '#FFFF99'),  # Light Yellow
-            ('Unhealthy for Sensitive Groups', '#FFD700'),  # Gold
-            ('Unhealthy', '#FFA500'),  # Orange
-            ('Very Unhealthy', '#FF6347'),  # Tomato Red
-            ('Hazardous', '#B22222')  # Firebrick Red
-        ])
+    @metrics.instrument('display_stations')
+    @cache.memoize('display_stations', version=version, key=lambda pollutant, regions, sy, sm, ey, em, viewport: (
+        pollutant, *month_range_key(sy, sm, ey, em), unordered_key(regions), viewport_key(viewport)))
+    def display_stations(pollutant, regions, start_year, start_month, end_year, end_month, viewport):
+        values, status = station_view(pollutant, regions, start_year, start_month, end_year, end_month, viewport)
+        # Only the points change; the map keeps its style and the user's viewport
+        stations = Patch()
+        for name in ('lat', 'lon', 'text'):
+            stations['data'][0][name] = values[name]
+        stations['data'][0]['marker']['size'] = values['marker']['size']
+        stations['data'][0]['marker']['color'] = values['marker']['color']
+        return stations, status
 
+    @cache.memoize('bar_chart', version=version, key=lambda pollutant, sy, sm, ey, em, regions: (
+        pollutant, *month_range_key(sy, sm, ey, em), unordered_key(regions)))
+    def bar_chart(pollutant, start_year, start_month, end_year, end_month, regions):
+        alt = charting()
+        data = dataset.current().backend
+        with phase('filter'):
+            top_countries = data.top_countries(
+                pollutant,
+                month_ordinal(start_year, start_month), month_ordinal(end_year, end_month),
+                continents=regions, n=15
+                )
+
+        aggregated_data = (top_countries[['value_mean', 'AQI_cat']]
+                           .rename(columns={'value_mean': 'mean_value', 'AQI_cat': 'most_frequent_cat'})
+                           .reset_index()
+                           )
+        
         bar = alt.Chart(aggregated_data).mark_bar().encode(
             x=alt.X('mean_value:Q', title='Average AQI Value'),
             y=alt.Y('countryname:N', title=None, sort='-x'),
-            fill=alt.Color('most_frequent_cat:N', scale=alt.Scale(domain=list(category_color_scale.keys()), range=list(category_color_scale.values())), legend=None),
+            fill=alt.Color('most_frequent_cat:N', scale=alt.Scale(domain=list(CATEGORY_COLORS.keys()), range=list(CATEGORY_COLORS.values())), legend=None),
             tooltip=[
                 alt.Tooltip('countryname:N', title='Country'),
                 alt.Tooltip('mean_value:Q', title='AQI value', format='.2f'),
@@ -240,7 +340,9 @@ def register_callbacks(app, data):
         ).properties(
             width=250,
             height=370
-        ).to_dict(format='vega')
+        )
+        with phase('figure'):
+            bar = compact_spec(bar.to_dict(format='vega'))
 
         if not aggregated_data.empty:
             first_country = aggregated_data.iloc[0]['countryname']
@@ -248,38 +350,52 @@ def register_callbacks(app, data):
             first_country = None
         
         return bar, first_country
-    
+
+    # Update top countries chart
     @app.callback(
-        Output("trend_chart", "spec"),
-        Input("pollutant_type_filter", "value"),
-        Input("country_filter", "value"),
-        Input("start_year", "value"),
-        Input("start_month", "value"),
-        Input("end_year", "value"),
-        Input("end_month", "value"),
+        Output("top_countries_chart", "spec"),
+        Output("first_country_name", "children"),
+        [
+            Input("pollutant_type_filter", "value"),
+            Input("start_year", "value"),
+            Input("start_month", "value"),
+            Input("end_year", "value"),
+            Input("end_month", "value"),
+            Input("region_filter", "value")
+        ],
+        prevent_initial_call=True
     )
-    def plot_line(pollutant, countries, start_year, start_month, end_year, end_month):
-        start_date_str = f"{start_year}-{start_month:02d}"
-        end_date_str = f"{end_year}-{end_month:02d}"
-        start_date = pd.to_datetime(start_date_str).date()
-        end_date = pd.to_datetime(end_date_str).date()
-        
-        filtered_data = data[
-            (data['time'] >= start_date) &
-            (data['time'] <= end_date) &
-            (data['pollutant'] == pollutant)
-        ]
+    @metrics.instrument('plot_bar')
+    def plot_bar(pollutant, start_year, start_month, end_year, end_month, regions):
+        bar, first_country = bar_chart(pollutant, start_year, start_month, end_year, end_month, regions)
+        return spec_update('bar', bar), first_country
+
+    @cache.memoize('trend_chart', version=version, key=lambda pollutant, countries, sy, sm, ey, em: (
+        pollutant, ordered_key(countries), *month_range_key(sy, sm, ey, em)))
+    def trend_chart(pollutant, countries, start_year, start_month, end_year, end_month):
+        alt = charting()
+        data = dataset.current().backend
         if countries:
             if not isinstance(countries, list):
                 countries = [countries]
 # Limit the number of countries to a maximum of four
             if len(countries) > 4:
                 countries = countries[:4]
-            filtered_data = filtered_data[data['countryname'].isin(countries)]
-        
-        filtered_data['time'] = filtered_data['time'].astype(str)
+
+        with phase('filter'):
+            filtered_data = data.slice(
+                pollutant,
+                month_ordinal(start_year, start_month), month_ordinal(end_year, end_month),
+                countries=countries
+                )
         
-        circles = alt.Chart(filtered_data).mark_circle(
+        # Aggregate server-side so the spec size does not grow with the date range
+        with phase('aggregate'):
+            points = trend_points(filtered_data, 'countryname', 'time_hour', 'AQI',
+                                  frequency=trend_frequency, point_budget=trend_point_budget)
+            trend_lines = linear_trend(filtered_data, 'countryname', 'time_hour', 'AQI')
+
+        circles = alt.Chart(points).mark_circle(
             opacity=0.3
             ).encode(
                 x=alt.X('time_hour:T', axis=alt.Axis(title='Date', format='%Y-%m')), 
@@ -296,13 +412,28 @@ def register_callbacks(app, data):
                 height=300
             )
         
-        circles_line = circles + circles.mark_line(size=3).transform_regression(
-                'time_hour',
-                'AQI',
-                groupby=['countryname']
+        circles_line = circles + alt.Chart(trend_lines).mark_line(size=3).encode(
+                x='time_hour:T',
+                y='AQI:Q',
+                color='countryname:N'
             )
 
-        return circles_line.to_dict(format='vega')
+        with phase('figure'):
+            return compact_spec(circles_line.to_dict(format='vega'))
+
+    @app.callback(
+        Output("trend_chart", "spec"),
+        Input("pollutant_type_filter", "value"),
+        Input("country_filter", "value"),
+        Input("start_year", "value"),
+        Input("start_month", "value"),
+        Input("end_year", "value"),
+        Input("end_month", "value"),
+        prevent_initial_call=True
+    )
+    @metrics.instrument('plot_line')
+    def plot_line(pollutant, countries, start_year, start_month, end_year, end_month):
+        return spec_update('trend', trend_chart(pollutant, countries, start_year, start_month, end_year, end_month))
 
     @app.callback(
         Output('data-summary-table', 'columns'),
@@ -313,54 +444,75 @@ def register_callbacks(app, data):
         Input("start_month", "value"),
         Input("end_year", "value"),
         Input("end_month", "value"),
+        prevent_initial_call=True
     )
+    @metrics.instrument('summary')
+    @cache.memoize('summary', version=version, key=lambda pollutant, countries, sy, sm, ey, em: (
+        pollutant, unordered_key(countries), *month_range_key(sy, sm, ey, em)))
     def summary(pollutant, countries, start_year, start_month, end_year, end_month):
-        start_date_str = f"{start_year}-{start_month:02d}"
-        end_date_str = f"{end_year}-{end_month:02d}"
-        start_date = pd.to_datetime(start_date_str).date()
-        end_date = pd.to_datetime(end_date_str).date()
-        
-        filtered_data = data[
-            (data['time'] >= start_date) &
-            (data['time'] <= end_date) &
-            (data['pollutant'] == pollutant)
-        ]
-        
-        if countries:
-            if not isinstance(countries, list):
-                countries = [countries]
-            filtered_data = filtered_data[data['countryname'].isin(countries)]
-        
-        country_stats = {}
-
-        for country in filtered_data['countryname'].unique():
-            country_data = filtered_data[filtered_data['countryname'] == country]['value']
-            min_value = round(country_data.min(), 2)
-            avg_value = round(country_data.mean(), 2)
-            max_value = round(country_data.max(), 2)
-            unit_meas = filtered_data[filtered_data['countryname'] == country]['unit'].iloc[0]
-            num_obs = country_data.shape[0]
-            pol_type = filtered_data[filtered_data['countryname'] == country]['pollutant'].iloc[0]
-            
-            country_stats[country] = {
-                'Country': country,
-                'Pollutant': pol_type,
-                'Unit of Measurement': unit_meas,
-                'Minimum': min_value, 
-                'Average': avg_value, 
-                'Maximum ': max_value,
-                'No. of Observations': num_obs
-                }
-        
-        table = (pd.DataFrame
-                .from_dict(country_stats, orient='index')
-                .T
-                .reset_index()
-                .rename(columns={'index': ''})
-                .tail(6)
-                )
+        data = dataset.current().backend
+        if countries and not isinstance(countries, list):
+            countries = [countries]
+
+        start, end = month_ordinal(start_year, start_month), month_ordinal(end_year, end_month)
+
+        # The monthly cube answers the default statistics; anything else (std,
+        # percentiles) comes from one grouped pass over the raw slice
+        if set(summary_statistics) <= set(CUBE_STATISTICS):
+            with phase('filter'):
+                stats = (data.totals(pollutant, start, end, countries=countries)
+                         .rename(columns={'value_min': 'min', 'value_mean': 'mean', 'value_max': 'max'}))
+        else:
+            with phase('filter'):
+                rows = data.slice(pollutant, start, end, countries=countries)
+            with phase('aggregate'):
+                stats = group_statistics(rows, 'countryname', 'value', summary_statistics, first=('unit',))
+
+        if stats.empty:
+            return [{"name": "", "id": ""}], []
+
+        with phase('figure'):
+            table = pd.DataFrame({'Pollutant': pollutant, 'Unit of Measurement': stats['unit']}, index=stats.index)
+            for statistic in summary_statistics:
+                column = stats[statistic] if statistic == 'count' else stats[statistic].round(2)
+                table[statistic_label(statistic)] = column
+
+            table = (table
+                    .T
+                    .reset_index()
+                    .rename(columns={'index': ''})
+                    )
 
-        columns = [{"name": i, "id": i} for i in table.columns]
-        summary_data = table.to_dict('records')
+            columns = [{"name": i, "id": i} for i in table.columns]
+            summary_data = table.to_dict('records')
 
         return columns, summary_data
+
+    # Outputs of the default view, embedded in the initial layout so that a new
+    # session fires no callbacks until a filter changes
+    def initial_outputs(pollutant, start_year, start_month, end_year, end_month):
+        dates = (start_year, start_month, end_year, end_month)
+        bar, first_country = bar_chart(pollutant, *dates, None)
+        trend = trend_chart(pollutant, first_country, *dates)
+        skeletons.update(bar=spec_skeleton(bar), trend=spec_skeleton(trend))
+        summary_columns, summary_data = summary(pollutant, first_country, *dates)
+        totals = dataset.current().backend.totals(
+            pollutant, month_ordinal(start_year, start_month), month_ordinal(end_year, end_month))
+        values = map_values(totals)
+        stations, station_status = station_view(pollutant, None, *dates, None)
+
+        return {
+            'region_options': update_region_options(pollutant, *dates),
+            'country_options': update_country_options(pollutant, *dates, None),
+            'country': first_country,
+            'map': base_choropleth().update_traces(**values),
+            'map_locations': values['locations'],
+            'stations': base_station_map().update_traces(**stations),
+            'station_status': station_status,
+            'bar': bar,
+            'trend': trend,
+            'summary_columns': summary_columns,
+            'summary_data': summary_data,
+        }
+
+    return initial_outputs
@@ -1,37 +1,41 @@
+import threading
 from dash import html, dcc
 import dash_bootstrap_components as dbc
 import dash_vega_components as dvc
 from dash import dash_table
+from encoding import dumps
 
-def get_filters(data):
+# Filter values of the view a new session starts with
+DEFAULT_FILTERS = dict(pollutant='PM2.5', start_year=2014, start_month=1, end_year=2024, end_month=12)
+
+def get_filters(initial):
     pollutants = ['PM2.5', 'PM10', 'CO', 'SO2', 'NO2', 'O3']
     pollutant_filter = html.Div([
         html.Label('Select pollutant:'),
         dcc.RadioItems(
             id='pollutant_type_filter',
             options=[{'label': i, 'value': i} for i in pollutants],
-            value='PM2.5',
+            value=DEFAULT_FILTERS['pollutant'],
             labelStyle={'display': 'inline-block', 'margin-right': '20px'}
         )
     ], style={'textAlign': 'center'})
 
-    unique_continents = data['continent'].unique()
     region_filter = html.Div([
         html.Label('Select region(s):'),
         dcc.Dropdown(
             id='region_filter',
-            options=[{"label": region, "value": region} for region in unique_continents],
+            options=initial['region_options'],
             multi=True,
             placeholder='Select multiple continents...'
         )
     ])
 
-    unique_countries = data['countryname'].unique()
     country_filter = html.Div([
         html.Label('Select countries:'),
         dcc.Dropdown(
             id='country_filter',
-            options=[{"label": country, "value": country} for country in unique_countries],
+            options=initial['country_options'],
+            value=initial['country'],
             multi=True,
             placeholder='Select up to 4 countries...'
         )
@@ -40,7 +44,7 @@ def get_filters(data):
     return pollutant_filter, region_filter, country_filter
 
 def get_datepickers():
-    years = list(range(2014, 2025))
+    years = list(range(DEFAULT_FILTERS['start_year'], DEFAULT_FILTERS['end_year'] + 1))
     month_names = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 
     start_year_dropdown = dcc.Dropdown(
@@ -56,7 +60,7 @@ def get_datepickers():
     start_month_dropdown = dcc.Dropdown(
         id='start_month',
         options=[{'label': month, 'value': i+1} for i, month in enumerate(month_names)],
-        value=1,
+        value=DEFAULT_FILTERS['start_month'],
         style={
         'color': '#333333',  # Dark text color
         'borderColor': '#333333'  # Dark border color
@@ -76,7 +80,7 @@ def get_datepickers():
     end_month_dropdown = dcc.Dropdown(
         id='end_month',
         options=[{'label': month, 'value': i+1} for i, month in enumerate(month_names)],
-        value=12,
+        value=DEFAULT_FILTERS['end_month'],
         style={
         'color': '#333333',  # Dark text color
         'borderColor': '#333333'  # Dark border color
@@ -181,54 +185,68 @@ collapse_section = dbc.Collapse(
     style={'width': '70%', 'margin': 'auto'}  # Adjust width and centering
 )
 
-graph_placeholder = html.Div([
-    html.H3('Worldwide Distribution'),
-    dcc.Loading(type='circle',
-                children = [dcc.Graph(id='graph')]),  # Placeholder for the pollution map
-])
+def get_graph_placeholder(initial):
+    return html.Div([
+        html.H3('Worldwide Distribution'),
+        dcc.Loading(type='circle',
+                    children = [dcc.Graph(id='graph', figure=initial['map'])]),  # Filters patch the data of this figure
+    ])
+
+def get_station_map(initial):
+    return html.Div([
+        html.H3('Stations in View'),
+        dcc.Graph(id='station-map', figure=initial['stations']),  # Pans and zooms patch the points in view
+        html.Label(initial['station_status'], id='station-status'),
+    ])
 
-top_countries_chart = html.Div([
-    html.H3('Top 15 Countries of Pollutant'),
-    dcc.Loading(type='circle', 
-                children=[
-                    dvc.Vega(id='top_countries_chart',
-                        opt={"renderer": "svg", "actions": False},
-                        spec={}, 
-                        style={'width': '100%', 'height': '100%'})
-                        ])
-])
+def get_top_countries_chart(initial):
+    return html.Div([
+        html.H3('Top 15 Countries of Pollutant'),
+        dcc.Loading(type='circle', 
+                    children=[
+                        dvc.Vega(id='top_countries_chart',
+                            opt={"renderer": "svg", "actions": False},
+                            spec=initial['bar'], 
+                            style={'width': '100%', 'height': '100%'})
+                            ])
+    ])
 
-data_summary = html.Div([
-    html.H3('Data Summary'),
-    dcc.Loading(type='circle',
-                children = [
-                    dash_table.DataTable(
-                        id='data-summary-table',
-                        style_table={
-                        'height': '300px',      
-                        'overflowY': 'scroll',
-                        'overflowX': 'scroll'     
-                        },
-                        style_cell={'textAlign': 'center'},
-                        style_header={
-                            'backgroundColor': 'white',
-                            'fontWeight': 'bold'},)
-                            ]),
-                            html.Label('Note: You may need to scroll for multi-country detail'),
-], style={'width': '100%'})
+def get_data_summary(initial):
+    return html.Div([
+        html.H3('Data Summary'),
+        dcc.Loading(type='circle',
+                    children = [
+                        dash_table.DataTable(
+                            id='data-summary-table',
+                            columns=initial['summary_columns'],
+                            data=initial['summary_data'],
+                            style_table={
+                            'height': '300px',      
+                            'overflowY': 'scroll',
+                            'overflowX': 'scroll'     
+                            },
+                            style_cell={'textAlign': 'center'},
+                            style_header={
+                                'backgroundColor': 'white',
+                                'fontWeight': 'bold'},)
+                                ]),
+                                html.Label('Note: You may need to scroll for multi-country detail'),
+    ], style={'width': '100%'})
 
-trend_chart = html.Div([
-    html.H3('Trend of Pollutant over time'),
-    dcc.Loading(type='circle',
-                children = [
-                    dvc.Vega(id='trend_chart', 
-                        opt={"renderer": "svg", "actions": False}, 
-                        spec={}, 
-                        style={'width': '100%', 'height': '100%'})])
-])
+def get_trend_chart(initial):
+    return html.Div([
+        html.H3('Trend of Pollutant over time'),
+        dcc.Loading(type='circle',
+                    children = [
+                        dvc.Vega(id='trend_chart', 
+                            opt={"renderer": "svg", "actions": False}, 
+                            spec=initial['trend'], 
+                            style={'width': '100%', 'height': '100%'})])
+    ])
 
-def get_layout(data):
-    pollutant_filter, region_filter, country_filter = get_filters(data)
+def get_layout(initial):
+    # initial holds the outputs of the default view (see register_callbacks)
+    pollutant_filter, region_filter, country_filter = get_filters(initial)
     start_year_dropdown, start_month_dropdown, end_year_dropdown, end_month_dropdown = get_datepickers()
 
     layout = html.Div([
@@ -265,19 +283,25 @@ def get_layout(data):
                 dbc.Row([dbc.Col(region_filter, width=3)], justify="start"),
                 html.Hr(), 
                 dbc.Row([
-                    dbc.Col(graph_placeholder, width=8),
-                    dbc.Col(top_countries_chart, width=4)
+                    dbc.Col(get_graph_placeholder(initial), width=8),
+                    dbc.Col(get_top_countries_chart(initial), width=4)
                 ], justify="around"),
             ]),
         ], className="mb-3"),
+        dbc.Card([
+            dbc.CardHeader("Monitoring Stations", className="font-weight-bold"),
+            dbc.CardBody([
+                dbc.Row([dbc.Col(get_station_map(initial), width=12)]),
+            ]),
+        ], className="mb-3"),
         dbc.Card([
             dbc.CardHeader("Country of Interest Trend", className="font-weight-bold"),
             dbc.CardBody([
                 dbc.Row([dbc.Col(country_filter, width=3)], justify="start"),
                 html.Hr(),  
                 dbc.Row([
-                    dbc.Col(trend_chart, width=4),
-                    dbc.Col(data_summary, width=4),
+                    dbc.Col(get_trend_chart(initial), width=4),
+                    dbc.Col(get_data_summary(initial), width=4),
                 ], justify="around"),
             ]),
         ], className="mb-3"),
@@ -297,8 +321,45 @@ def get_layout(data):
         ]),
         html.Div(id='dummy_output'),
         dcc.Store(id='selected-countries', data=[]),
-        html.Div(id='first_country_name', style={'display': 'none'})
+        dcc.Store(id='map-geometry', data='world'),
+        dcc.Store(id='map-locations', data=initial['map_locations']),
+        dcc.Store(id='station-viewport', data=None),
+        html.Div(initial['country'], id='first_country_name', style={'display': 'none'})
     ])
 
 
     return layout
+
+# Stand-ins for the initial outputs where only the component tree is needed
+EMPTY_OUTPUTS = dict(region_options=[], country_options=[], country=None, map={}, map_locations=[],
+                     stations={}, station_status='', bar={}, trend={}, summary_columns=[], summary_data=[])
+
+class InitialLayout:
+    # The layout a new session starts from, with the default view already
+    # filled in. It is built and serialized once per data version, so serving
+    # it costs no queries and no JSON encoding.
+    def __init__(self, dataset, initial_outputs):
+        self.dataset = dataset
+        self.initial_outputs = initial_outputs
+        self.lock = threading.Lock()
+        self.version = None
+
+    def build(self):
+        version = self.dataset.current().version
+        with self.lock:
+            if version != self.version:
+                self.layout = get_layout(self.initial_outputs(**DEFAULT_FILTERS))
+                self.json = dumps(self.layout)
+                self.version = version
+            return self.layout, self.json
+
+    def skeleton(self):
+        # The same components without data, for Dash to validate callbacks
+        # against without building the real layout at import time
+        return get_layout(EMPTY_OUTPUTS)
+
+    def __call__(self):
+        return self.build()[0]
+
+    def serialized(self):
+        return self.build()[1]
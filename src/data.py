@@ -1,8 +1,335 @@
+import json
+import os
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from pandas.api.types import union_categoricals
+from aggregate import category_counts, mode_of_counts
+
+AQI_CATEGORIES = ['Good', 'Moderate', 'Unhealthy for Sensitive Groups', 'Unhealthy', 'Very Unhealthy', 'Hazardous']
+
+CATEGORY_COLORS = dict([
+    ('Good', '#98FB98'),  # Pale Green
+    ('Moderate', '#FFFF99'),  # Light Yellow
+    ('Unhealthy for Sensitive Groups', '#FFD700'),  # Gold
+    ('Unhealthy', '#FFA500'),  # Orange
+    ('Very Unhealthy', '#FF6347'),  # Tomato Red
+    ('Hazardous', '#B22222')  # Firebrick Red
+])
+
+CUBE_KEYS = ['pollutant', 'month', 'continent', 'countryname']
+
+# Summary statistics of value that can be answered from the cube alone
+CUBE_STATISTICS = ('min', 'mean', 'max', 'count')
+
+DATA_PATH = '../data/processed/world_air_quality.parquet'
+SNAPSHOT_PATH = '../data/processed/world_air_quality.arrow'
+
+# Batches appended by ingest.py, hive-partitioned by pollutant and year_month,
+# with a manifest listing the files of every batch
+UPDATES_PATH = '../data/processed/updates'
+MANIFEST_NAME = '_manifest.json'
+
+UPDATE_PARTITIONING = ds.partitioning(
+    pa.schema([('pollutant', pa.string()), ('year_month', pa.string())]), flavor='hive')
+
+MEASUREMENT_SCHEMA = pa.schema([
+    ('coordinates', pa.string()),
+    ('pollutant', pa.string()),
+    ('time', pa.date32()),
+    ('countryname', pa.string()),
+    ('time_hour', pa.timestamp('ns')),
+    ('continent', pa.string()),
+    ('value', pa.float64()),
+    ('unit', pa.string()),
+    ('AQI', pa.float64()),
+    ('AQI_cat', pa.string()),
+])
+
+# Bump when the snapshot layout or dtype handling changes so stale files are rebuilt
+SNAPSHOT_VERSION = 2
+
+# Low-cardinality string columns, kept dictionary-encoded instead of as Python strings
+CATEGORICAL_COLUMNS = ['coordinates', 'pollutant', 'countryname', 'continent', 'unit', 'AQI_cat']
 
-def load_data():
-    data = pd.read_parquet('../data/processed/world_air_quality.parquet')
+# Float columns stored as float32 when every value survives the round trip to this tolerance
+FLOAT32_TOLERANCE = 0.005
+
+def load_data(path=DATA_PATH, snapshot_path=SNAPSHOT_PATH, updates_path=UPDATES_PATH):
+    # Every gunicorn worker memory-maps the same sorted Arrow snapshot, so the
+    # table lives once in the page cache instead of once per process
+    if not snapshot_path:
+        return read_measurements(path, updates_path)
+    if not snapshot_is_current(snapshot_path, path, updates_path):
+        write_snapshot(read_measurements(path, updates_path), snapshot_path)
+    return AirQualityData.from_snapshot(snapshot_path)
+
+def read_measurements(path=DATA_PATH, updates_path=UPDATES_PATH):
+    # Reading the string columns as Arrow dictionaries means the Python strings
+    # are never materialized; they arrive in pandas as categoricals
+    table = pq.read_table(path, read_dictionary=CATEGORICAL_COLUMNS)
+    table = table.select(MEASUREMENT_SCHEMA.names)
+    manifest = read_manifest(updates_path)
+    if manifest['batches']:
+        updates = read_updates(updates_path, manifest['batches'])
+        table = pa.concat_tables([table, updates.cast(table.schema)])
+    data = table.to_pandas(date_as_object=False)
     # data['time_hour'] = pd.to_datetime(data['time_hour']).dt.tz_convert(None)
-    # data['time'] = pd.to_datetime(data['time']).dt.date
+    return AirQualityData(data, version=manifest['version'])
+
+def manifest_path(updates_path=UPDATES_PATH):
+    return os.path.join(updates_path, MANIFEST_NAME)
+
+def read_manifest(updates_path=UPDATES_PATH):
+    if not updates_path or not os.path.exists(manifest_path(updates_path)):
+        return {'version': 0, 'batches': []}
+    with open(manifest_path(updates_path), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_manifest(manifest, updates_path=UPDATES_PATH):
+    # Replaced atomically; a new manifest version is what tells readers that
+    # new batches are complete and can be loaded
+    path = manifest_path(updates_path)
+    partial = f"{path}.{os.getpid()}.partial"
+    with open(partial, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(partial, path)
+
+def update_files(updates_path, batches):
+    return [os.path.join(updates_path, file) for batch in batches for file in batch['files']]
+
+def read_updates(updates_path, batches):
+    # Only the files of the given batches are read, so applying a batch costs
+    # the size of the batch rather than of the dataset
+    files = update_files(updates_path, batches)
+    if not files:
+        return MEASUREMENT_SCHEMA.empty_table()
+    dataset = ds.dataset(files, format='parquet', partitioning=UPDATE_PARTITIONING,
+                         partition_base_dir=updates_path)
+    return dataset.to_table(columns=MEASUREMENT_SCHEMA.names).cast(MEASUREMENT_SCHEMA)
+
+def snapshot_is_current(snapshot_path, path, updates_path=UPDATES_PATH):
+    if not os.path.exists(snapshot_path) or os.path.getmtime(snapshot_path) < os.path.getmtime(path):
+        return False
+    with pa.memory_map(snapshot_path, 'r') as source:
+        metadata = ipc.open_file(source).schema.metadata or {}
+    return (metadata.get(b'snapshot_version') == str(SNAPSHOT_VERSION).encode()
+            and metadata.get(b'updates_version') == str(read_manifest(updates_path)['version']).encode())
+
+def snapshot_table(data):
+    # Float columns keep NaN as a value rather than a null so they map zero-copy
+    arrays = {}
+    for column in data.table:
+        values = data.table[column]
+        if values.dtype.kind == 'f':
+            arrays[column] = pa.array(values.to_numpy(), from_pandas=False)
+        else:
+            arrays[column] = pa.Array.from_pandas(values)
+    arrays['month'] = pa.array(data.months)
+    return pa.table(arrays, metadata={
+        'snapshot_version': str(SNAPSHOT_VERSION),
+        'updates_version': str(data.version),
+    })
+
+def write_snapshot(data, snapshot_path):
+    table = snapshot_table(data)
+
+    # Written beside the target and renamed, so a worker never maps a partial file
+    partial = f"{snapshot_path}.{os.getpid()}.partial"
+    with pa.OSFile(partial, 'wb') as sink:
+        with ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(partial, snapshot_path)
+
+def optimize_dtypes(data):
+    for column in CATEGORICAL_COLUMNS:
+        if column not in data:
+            continue
+        if not isinstance(data[column].dtype, pd.CategoricalDtype):
+            data[column] = data[column].astype('category')
+        # Sorted categories keep code order and label order the same
+        data[column] = data[column].cat.reorder_categories(sorted(data[column].cat.categories))
+    data['AQI_cat'] = data['AQI_cat'].cat.set_categories(AQI_CATEGORIES, ordered=True)
+    data['time'] = pd.to_datetime(data['time'])
+
+    for column in data.select_dtypes('float64'):
+        values = data[column].to_numpy()
+        downcast = values.astype(np.float32)
+        if np.allclose(downcast, values, rtol=0, atol=FLOAT32_TOLERANCE, equal_nan=True):
+            data[column] = downcast
     return data
 
+def month_ordinal(year, month):
+    return year * 12 + month - 1
+
+def build_cube(data):
+    # Monthly aggregates keyed by pollutant, month, continent and country so that
+    # date-range queries only have to combine month slices instead of raw rows
+    time = pd.to_datetime(data['time'])
+    # Sums are accumulated in float64 even when the columns are stored as float32
+    keyed = data.assign(
+        month=month_ordinal(time.dt.year, time.dt.month),
+        value=data['value'].astype('float64'),
+        AQI=data['AQI'].astype('float64'),
+    )
+
+    grouped = keyed.groupby(CUBE_KEYS, sort=True, observed=True)
+    stats = grouped.agg(
+        # Readings with a value, as group_statistics counts them; value_mean divides by it
+        count=('value', 'count'),
+        value_sum=('value', 'sum'),
+        value_min=('value', 'min'),
+        value_max=('value', 'max'),
+        AQI_sum=('AQI', 'sum'),
+        # Readings with an AQI; the mean AQI is taken over these only
+        AQI_count=('AQI', 'count'),
+        AQI_min=('AQI', 'min'),
+        AQI_max=('AQI', 'max'),
+        unit=('unit', 'first'),
+    )
+    stats[AQI_CATEGORIES] = category_counts(
+        grouped.ngroup().to_numpy(), grouped.ngroups,
+        keyed['AQI_cat'].cat.codes.to_numpy(), len(AQI_CATEGORIES)
+        )
+
+    return stats
+
+def merge_cube(cube, update):
+    # Counts, sums and category counts add up and extremes combine, so cube rows
+    # for new measurements fold into the existing cube without revisiting old rows
+    aggregations = dict.fromkeys(['count', 'value_sum', 'AQI_sum', 'AQI_count'] + AQI_CATEGORIES, 'sum')
+    aggregations.update(value_min='min', value_max='max', AQI_min='min', AQI_max='max', unit='first')
+    return (pd.concat([cube, update])
+            .groupby(level=CUBE_KEYS, sort=True, observed=True)
+            .agg(aggregations)
+            [cube.columns]
+            )
+
+def query_cube(cube, pollutant, start_month, end_month, regions=None, countries=None):
+    # Combine the month slices of one pollutant into per-country totals.
+    # The index is sorted, so the slice is a binary search rather than a scan.
+    if start_month > end_month or pollutant not in cube.index.levels[0]:
+        rows = cube.iloc[:0]
+    else:
+        rows = cube.loc[(pollutant, start_month):(pollutant, end_month)]
+    rows = rows.reset_index(['pollutant', 'month'], drop=True)
+
+    if regions:
+        rows = rows[rows.index.get_level_values('continent').isin(regions)]
+    if countries:
+        rows = rows[rows.index.get_level_values('countryname').isin(countries)]
+
+    aggregations = dict.fromkeys(['count', 'value_sum', 'AQI_sum', 'AQI_count'] + AQI_CATEGORIES, 'sum')
+    aggregations.update(value_min='min', value_max='max', AQI_min='min', AQI_max='max', unit='first')
+    totals = (rows
+              .groupby(['continent', 'countryname'], observed=True)
+              .agg(aggregations)
+              .reset_index('continent')
+              )
+    totals['value_mean'] = totals['value_sum'] / totals['count']
+    totals['AQI_mean'] = totals['AQI_sum'] / totals['AQI_count']
+    totals['AQI_cat'] = mode_of_counts(totals[AQI_CATEGORIES].to_numpy(), AQI_CATEGORIES)
+    return totals
+
+class AirQualityData:
+    # Read-only access to the measurements, sorted by (pollutant, time) so that
+    # a pollutant and date-range filter is two binary searches and a row slice
+    def __init__(self, table, months=None, arrow=None, version=0, cube=None):
+        # A table that comes with its month index is already optimized and sorted
+        if months is None:
+            table = optimize_dtypes(table)
+            table = table.sort_values(['pollutant', 'time'], kind='stable', ignore_index=True)
+            time = table['time'].dt
+            months = month_ordinal(time.year, time.month).to_numpy(dtype=np.int32)
+        self.table = table
+        self.months = months
+        self.arrow = arrow
+        # Manifest version of the last update batch included in the table
+        self.version = version
+
+        codes = self.table['pollutant'].cat.codes.to_numpy()
+        categories = self.table['pollutant'].cat.categories
+        starts = np.searchsorted(codes, np.arange(len(categories)), side='left')
+        stops = np.searchsorted(codes, np.arange(len(categories)), side='right')
+        self.bounds = {pollutant: (start, stop)
+                       for pollutant, start, stop in zip(categories, starts, stops) if stop > start}
+        self.pollutants = list(self.bounds)
+
+        self.cube = build_cube(self.table) if cube is None else cube
+
+    @classmethod
+    def from_snapshot(cls, snapshot_path, cube=None):
+        # Columns without nulls become read-only pandas views of the mapped file.
+        # A cube already aggregated for the same rows can be passed in.
+        source = pa.memory_map(snapshot_path, 'r')
+        snapshot = ipc.open_file(source).read_all()
+        months = snapshot.column('month').combine_chunks().to_numpy()
+        table = snapshot.drop_columns(['month']).to_pandas(split_blocks=True)
+        version = int(snapshot.schema.metadata.get(b'updates_version', 0))
+        return cls(table, months=months, arrow=snapshot, version=version, cube=cube)
+
+    def with_rows(self, rows, version):
+        # A new dataset with rows appended; only the new rows are aggregated
+        rows = optimize_dtypes(rows)
+        cube = merge_cube(self.cube, build_cube(rows))
+        table = {}
+        for column in self.table:
+            if column in CATEGORICAL_COLUMNS:
+                values = [self.table[column], rows[column]]
+                table[column] = union_categoricals(values, sort_categories=not values[0].cat.ordered)
+            else:
+                table[column] = np.concatenate([self.table[column].to_numpy(), rows[column].to_numpy()])
+        return AirQualityData(pd.DataFrame(table), version=version, cube=cube)
+
+    def apply_updates(self, updates_path=UPDATES_PATH):
+        # Loads only the batches ingested since this dataset was read; returns
+        # self when there are none
+        manifest = read_manifest(updates_path)
+        batches = [batch for batch in manifest['batches'] if batch['version'] > self.version]
+        if not batches:
+            return self
+        rows = read_updates(updates_path, batches).to_pandas(date_as_object=False)
+        return self.with_rows(rows, manifest['version'])
+
+    def arrow_table(self):
+        # The table with its month index as Arrow, for engines that scan Arrow directly
+        if self.arrow is None:
+            self.arrow = snapshot_table(self)
+        return self.arrow
+
+    def __len__(self):
+        return len(self.table)
+
+    def memory_usage(self):
+        # Resident bytes per column of the table and of the derived indexes
+        usage = self.table.memory_usage(index=False, deep=True)
+        usage['(months)'] = self.months.nbytes
+        usage['(cube)'] = self.cube.memory_usage(deep=True).sum()
+        return usage
+
+    def row_range(self, pollutant, start_month, end_month):
+        # Row offsets of one pollutant's measurements between two months, inclusive
+        if pollutant not in self.bounds or start_month > end_month:
+            return 0, 0
+        lo, hi = self.bounds[pollutant]
+        months = self.months[lo:hi]
+        return (lo + np.searchsorted(months, start_month, side='left'),
+                lo + np.searchsorted(months, end_month, side='right'))
+
+    def slice(self, pollutant, start_month, end_month, continents=None, countries=None):
+        start, stop = self.row_range(pollutant, start_month, end_month)
+        rows = self.table.iloc[start:stop]
+
+        if continents:
+            rows = rows[rows['continent'].isin(continents)]
+        if countries:
+            rows = rows[rows['countryname'].isin(countries)]
+        return rows
+
+    def totals(self, pollutant, start_month, end_month, continents=None, countries=None):
+        return query_cube(self.cube, pollutant, start_month, end_month,
+                          regions=continents, countries=countries)
@@ -0,0 +1,116 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from data import (DATA_PATH, SNAPSHOT_PATH, UPDATES_PATH, AirQualityData, load_data, read_manifest,
+                  snapshot_is_current, write_snapshot)
+from forks import reset_in_child
+
+logger = logging.getLogger(__name__)
+
+# One loaded version of the data together with the backend that queries it
+DatasetView = namedtuple('DatasetView', ['version', 'data', 'backend'])
+
+def source_version(path=DATA_PATH):
+    return str(os.stat(path).st_mtime_ns)
+
+class DatasetHandle:
+    # The current dataset, replaced as a whole when the files change. Callbacks
+    # take one view at the start of a call and query only that view, so a swap
+    # never changes the data under a callback that is already running.
+    #
+    # The version is derived from the parquet file and the update manifest, so
+    # every worker gives the same data the same version and a shared result
+    # cache can be keyed on it.
+    def __init__(self, make_backend, path=DATA_PATH, snapshot_path=SNAPSHOT_PATH,
+                 updates_path=UPDATES_PATH, poll_interval=None):
+        self.make_backend = make_backend
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.updates_path = updates_path
+        self.poll_interval = poll_interval
+        self.reload_lock = threading.Lock()
+        reset_in_child(self)
+        self.watcher_pid = None
+
+        source = source_version(path)
+        data = load_data(path, snapshot_path, updates_path)
+        self.view = self.make_view(source, data)
+
+    def after_fork(self):
+        # A reload running in the parent does not continue in the child
+        self.reload_lock = threading.Lock()
+
+    def make_view(self, source, data):
+        return DatasetView(f"{source}.{data.version}", data, self.make_backend(data))
+
+    def current(self):
+        return self.view
+
+    def start_watching(self):
+        # Threads do not survive a fork, so each worker starts its own watcher once
+        # it has forked. Never called in a preloading master or in a job process.
+        if self.poll_interval and self.watcher_pid != os.getpid():
+            self.watch()
+
+    def is_stale(self):
+        source, _, updates = self.view.version.partition('.')
+        return (source != source_version(self.path)
+                or updates != str(read_manifest(self.updates_path)['version']))
+
+    def reload(self):
+        # Builds the new version beside the current one and swaps the reference;
+        # requests keep being served from the old version meanwhile
+        with self.reload_lock:
+            if not self.is_stale():
+                return False
+            started = time.perf_counter()
+            source = source_version(self.path)
+            updates = read_manifest(self.updates_path)['version']
+            if source == self.view.version.partition('.')[0] and updates > self.view.data.version:
+                # Only batches were ingested: fold in just the new partitions
+                data = self.shared(self.view.data.apply_updates(self.updates_path))
+            else:
+                data = load_data(self.path, self.snapshot_path, self.updates_path)
+            previous, self.view = self.view, self.make_view(source, data)
+            logger.info("Reloaded data %s -> %s (%d rows) in %.2fs", previous.version, self.view.version,
+                        len(data), time.perf_counter() - started)
+            return True
+
+    def shared(self, data):
+        # Every worker folds in the same batches. The first to finish writes the
+        # snapshot; all of them then map it, so the table stays shared in the page
+        # cache. Only the cube, aggregated from the new rows alone, is kept per worker.
+        if not self.snapshot_path:
+            return data
+        if not snapshot_is_current(self.snapshot_path, self.path, self.updates_path):
+            write_snapshot(data, self.snapshot_path)
+        mapped = AirQualityData.from_snapshot(self.snapshot_path, cube=data.cube)
+        # Another batch may have been published and written meanwhile; then keep
+        # the private table, which matches the cube, until the next reload
+        return mapped if mapped.version == data.version else data
+
+    def reload_in_background(self):
+        thread = threading.Thread(target=self.try_reload, daemon=True)
+        thread.start()
+        return thread
+
+    def try_reload(self):
+        try:
+            return self.reload()
+        except Exception:
+            # A broken file must not take the server down; keep serving the old version
+            logger.exception("Reloading data failed; still serving version %s", self.view.version)
+            return False
+
+    def watch(self):
+        self.watcher_pid = os.getpid()
+
+        def poll():
+            while True:
+                time.sleep(self.poll_interval)
+                self.try_reload()
+
+        threading.Thread(target=poll, name='dataset-watcher', daemon=True).start()
@@ -0,0 +1,96 @@
+import json
+import sys
+
+from plotly.io.json import to_json_plotly
+from plotly.utils import PlotlyJSONEncoder
+
+# Escapes Dash applies to every response, so JSON can sit inside a <script> tag
+UNSAFE_CHARACTERS = (
+    ('<', '\\u003c'),
+    ('>', '\\u003e'),
+    ('/', '\\u002f'),
+    ('\u2028', '\\u2028'),
+    ('\u2029', '\\u2029'),
+)
+
+def escape(text):
+    for character, escaped in UNSAFE_CHARACTERS:
+        if character in text:
+            text = text.replace(character, escaped)
+    return text
+
+def plotly_default(obj):
+    # Called by orjson for anything it cannot encode natively: figures, Patch
+    # objects and Dash components, numpy arrays that are not contiguous numbers,
+    # and the pandas and numpy scalars PlotlyJSONEncoder knows how to convert
+    to_plotly_json = getattr(obj, 'to_plotly_json', None)
+    if to_plotly_json is not None:
+        return to_plotly_json()
+    return PlotlyJSONEncoder().default(obj)
+
+def orjson_dumps(obj):
+    import orjson
+
+    # Numeric numpy arrays are written straight from their buffers, without
+    # the tolist() copy the standard encoder makes
+    options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    return escape(orjson.dumps(obj, default=plotly_default, option=options).decode())
+
+def orjson_loads(text):
+    import orjson
+
+    return orjson.loads(text)
+
+# (encode, decode) pairs; 'json' is what Dash and plotly use by default
+CODECS = {
+    'json': (lambda obj: to_json_plotly(obj, engine='json'), json.loads),
+    'orjson': (orjson_dumps, orjson_loads),
+}
+
+codec = CODECS['json']
+
+def dumps(obj):
+    return codec[0](obj)
+
+def loads(text):
+    return codec[1](text)
+
+def dash_modules():
+    return [module for name, module in list(sys.modules.items())
+            if module is not None and name.split('.')[0] == 'dash']
+
+def use_encoder(name):
+    # Dash encodes callback responses, the layout, its config and validated
+    # outputs with the to_json it imported by name, so that name is swapped in
+    # every Dash module holding it. The result cache and the prebuilt layout
+    # follow through dumps() and loads(). Plotly's own orjson engine would need
+    # no swap, but writes the layout more than twice as slowly as orjson_dumps.
+    global codec
+    if name not in CODECS:
+        raise ValueError(f"Unknown JSON encoder {name!r}, expected one of {', '.join(CODECS)}")
+    import dash
+    import dash._callback
+    import dash._utils
+    import dash._validate
+    import dash.dash
+
+    # These are Dash internals; if a release moves them, part of the responses
+    # would quietly stay on the old encoder, so start-up fails instead
+    current = vars(dash._utils).get('to_json')
+    encoders = {current} | {encode for encode, _ in CODECS.values()}
+    sites = [module for module in dash_modules() if vars(module).get('to_json') in encoders]
+    expected = (dash._callback, dash._utils, dash._validate, dash.dash)
+    missing = [module.__name__ for module in expected if module not in sites]
+    if current is None or missing:
+        raise RuntimeError(f"to_json not found as expected in {', '.join(missing) or 'dash._utils'} "
+                           f"of Dash {dash.__version__}; cannot switch the JSON encoder to {name!r}")
+
+    # Encoding an empty object fails here rather than on the first request if orjson is missing
+    CODECS[name][0]({})
+    codec = CODECS[name]
+    for module in sites:
+        module.to_json = codec[0]
+    stale = [module.__name__ for module in dash_modules()
+             if vars(module).get('to_json') in encoders - {codec[0]}]
+    if stale:
+        raise RuntimeError(f"to_json could not be replaced in {', '.join(stale)}")
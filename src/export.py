@@ -0,0 +1,123 @@
+import re
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as csv
+import pyarrow.ipc as ipc
+
+from data import MEASUREMENT_SCHEMA, month_ordinal
+
+# Rows read from the table per step; memory use is bounded by this, not by the export size
+EXPORT_BATCH_ROWS = 16 * 1024
+
+# Media type and file extension of each export format
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+def parse_filters(args, defaults):
+    # The filters of the dashboard callbacks, from a query string; regions and
+    # countries are repeated parameters. Bad dates raise ValueError.
+    filters = {}
+    for key in ('start_year', 'start_month', 'end_year', 'end_month'):
+        value = str(args.get(key, defaults[key]))
+        # Plain digits only: int() would also take signs, spaces, underscores and non-ASCII digits
+        if not re.fullmatch(r'[0-9]{1,4}', value):
+            raise ValueError(f"{key} must be a whole number of at most four digits")
+        filters[key] = int(value)
+    for key in ('start_month', 'end_month'):
+        if not 1 <= filters[key] <= 12:
+            raise ValueError(f"{key} must be between 1 and 12")
+    if (month_ordinal(filters['start_year'], filters['start_month'])
+            > month_ordinal(filters['end_year'], filters['end_month'])):
+        raise ValueError("the start month must not be after the end month")
+    return dict(
+        filters,
+        pollutant=args.get('pollutant', defaults['pollutant']),
+        regions=args.getlist('regions') or None,
+        countries=args.getlist('countries') or None,
+    )
+
+def export_schema(table):
+    # Columns as in the parquet file, except floats the table keeps as float32
+    return pa.schema([
+        pa.field(field.name, pa.float32()) if table[field.name].dtype == np.float32 else field
+        for field in MEASUREMENT_SCHEMA
+        ])
+
+def export_batches(data, pollutant, start_year, start_month, end_year, end_month, regions=None, countries=None):
+    # The rows AirQualityData.slice would return, read a step at a time
+    start, stop = data.row_range(pollutant, month_ordinal(start_year, start_month), month_ordinal(end_year, end_month))
+    schema = export_schema(data.table)
+    for offset in range(start, stop, EXPORT_BATCH_ROWS):
+        rows = data.table.iloc[offset:min(offset + EXPORT_BATCH_ROWS, stop)]
+        if regions:
+            rows = rows[rows['continent'].isin(regions)]
+        if countries:
+            rows = rows[rows['countryname'].isin(countries)]
+        if len(rows):
+            yield pa.RecordBatch.from_pandas(rows, schema=schema, preserve_index=False)
+
+class ChunkSink:
+    # A write-only file for the Arrow writers, emptied after every batch
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def write_batches(writer, sink, batches):
+    # The header or schema goes out before the first batch, even when there are none
+    yield sink.drain()
+    for batch in batches:
+        writer.write(batch)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def ndjson_lines(batch):
+    # float32 goes through its shortest text form, so 1.1 is not written as
+    # 1.100000023841858; dates are written as ISO dates
+    columns = {}
+    for name, column in zip(batch.schema.names, batch.columns):
+        if pa.types.is_float32(column.type):
+            column = pc.cast(pc.cast(column, pa.string()), pa.float64())
+        elif pa.types.is_date(column.type):
+            column = pc.cast(column, pa.string())
+        columns[name] = column
+    rows = pa.table(columns).to_pandas()
+    return rows.to_json(orient='records', lines=True, date_format='iso', date_unit='s').encode()
+
+def stream_export(data, fmt, filters):
+    # Yields the encoded export piece by piece, for a streamed response
+    batches = export_batches(data, **filters)
+    if fmt == 'ndjson':
+        for batch in batches:
+            yield ndjson_lines(batch)
+        return
+    sink = ChunkSink()
+    schema = export_schema(data.table)
+    if fmt == 'csv':
+        yield from write_batches(csv.CSVWriter(sink, schema), sink, batches)
+    else:
+        yield from write_batches(ipc.new_stream(sink, schema), sink, batches)
+
+def export_filename(filters, extension):
+    return (f"{filters['pollutant']}-{filters['start_year']}-{filters['start_month']:02d}"
+            f"-{filters['end_year']}-{filters['end_month']:02d}.{extension}")
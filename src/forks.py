@@ -0,0 +1,17 @@
+import os
+import weakref
+
+# Objects whose after_fork() runs in every forked child. A thread of the parent
+# may hold their locks at the fork, and as that thread does not exist in the
+# child they would never be released. The set holds them weakly, so replaced
+# dataset versions are still collected.
+resettable = weakref.WeakSet()
+
+def reset_in_child(obj):
+    resettable.add(obj)
+
+def after_fork():
+    for obj in list(resettable):
+        obj.after_fork()
+
+os.register_at_fork(after_in_child=after_fork)
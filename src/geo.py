@@ -0,0 +1,173 @@
+import functools
+import json
+import os
+from collections import defaultdict
+
+import numpy as np
+import plotly.graph_objects as go
+
+from data import AQI_CATEGORIES, CATEGORY_COLORS
+
+RAW_GEOJSON = '../data/raw/custom.geo.json'
+GEOMETRY_DIR = '../data/processed'
+
+# Douglas-Peucker tolerance in degrees for each map zoom level
+SIMPLIFY_TOLERANCE = {
+    'world': 0.2,
+    'region': 0.05,
+}
+
+# Coordinates are rounded to this many decimals, well below the tolerance
+COORDINATE_DECIMALS = {
+    'world': 2,
+    'region': 3,
+}
+
+def geometry_path(level):
+    return os.path.join(GEOMETRY_DIR, f'countries_{level}.geo.json')
+
+def polygons(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    return geometry['coordinates']
+
+def douglas_peucker(points, tolerance):
+    # Indices of the points kept when simplifying an open line with fixed endpoints
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        farthest = int(distances.argmax())
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.extend([(start, split), (split, end)])
+    return np.flatnonzero(keep)
+
+def owners_by_vertex(features):
+    owners = defaultdict(set)
+    for i, feature in enumerate(features):
+        for polygon in polygons(feature['geometry']):
+            for ring in polygon:
+                for point in ring:
+                    owners[tuple(point)].add(i)
+    return owners
+
+def simplify_ring(ring, owners, tolerance):
+    # Vertices where the set of countries sharing the border changes are pinned,
+    # so both sides of a shared border simplify the same arc to the same points
+    points = np.asarray(ring[:-1], dtype=float)
+    n = len(points)
+    if n < 4:
+        return ring
+    shared = [frozenset(owners[tuple(point)]) for point in ring[:-1]]
+    pinned = [i for i in range(n) if shared[i] != shared[i - 1] or shared[i] != shared[(i + 1) % n]]
+    if not pinned:
+        # An island: pin the first vertex and the one farthest from it
+        pinned = [0, int(np.hypot(*(points - points[0]).T).argmax())]
+
+    kept = []
+    for a, b in zip(pinned, pinned[1:] + [pinned[0] + n]):
+        arc = points[np.arange(a, b + 1) % n]
+        kept.extend((a + douglas_peucker(arc, tolerance)[:-1]) % n)
+    kept = sorted(set(kept))
+    if len(kept) < 3:
+        return None
+    simplified = points[kept].tolist()
+    return simplified + [simplified[0]]
+
+def simplify_geojson(geojson, tolerance, decimals):
+    # Keep only properties.admin, which the choropleth uses as its feature id,
+    # and drop rings that collapse at this tolerance
+    features = geojson['features']
+    owners = owners_by_vertex(features)
+    simplified = []
+    for feature in features:
+        parts = []
+        for polygon in polygons(feature['geometry']):
+            rings = [simplify_ring(ring, owners, tolerance) for ring in polygon]
+            if rings[0] is None:
+                continue
+            parts.append([np.round(ring, decimals).tolist() for ring in rings if ring is not None])
+        if not parts:
+            # Never drop a country entirely; keep its largest part unsimplified
+            parts = [max(polygons(feature['geometry']), key=lambda polygon: len(polygon[0]))]
+        geometry = ({'type': 'Polygon', 'coordinates': parts[0]} if len(parts) == 1
+                    else {'type': 'MultiPolygon', 'coordinates': parts})
+        simplified.append({
+            'type': 'Feature',
+            'properties': {'admin': feature['properties']['admin']},
+            'geometry': geometry,
+        })
+    return {'type': 'FeatureCollection', 'features': simplified}
+
+def build_geometry(levels=tuple(SIMPLIFY_TOLERANCE)):
+    with open(RAW_GEOJSON, 'r', encoding='utf-8') as f:
+        geojson = json.load(f)
+    for level in levels:
+        simplified = simplify_geojson(geojson, SIMPLIFY_TOLERANCE[level], COORDINATE_DECIMALS[level])
+        with open(geometry_path(level), 'w', encoding='utf-8') as f:
+            json.dump(simplified, f, separators=(',', ':'), ensure_ascii=False)
+
+@functools.lru_cache()
+def load_geometry(level='world'):
+    path = geometry_path(level)
+    if not os.path.exists(path):
+        build_geometry([level])
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def geometry_subset(level, countries):
+    # Only features listed in a choropleth's locations are drawn, so a zoomed-in
+    # map can ship just the geometry of the countries it colours
+    countries = set(countries)
+    features = [feature for feature in load_geometry(level)['features']
+                if feature['properties']['admin'] in countries]
+    return {'type': 'FeatureCollection', 'features': features}
+
+def base_choropleth():
+    # A single trace holds the world geometry; filter changes only patch the
+    # locations, category codes and selection outlines of this trace
+    n = len(AQI_CATEGORIES)
+    colorscale = []
+    for i, category in enumerate(AQI_CATEGORIES):
+        colorscale += [[i / n, CATEGORY_COLORS[category]], [(i + 1) / n, CATEGORY_COLORS[category]]]
+
+    figure = go.Figure(go.Choropleth(
+        geojson=load_geometry('world'),
+        featureidkey='properties.admin',
+        locations=[],
+        z=[],
+        text=[],
+        zmin=-0.5,
+        zmax=n - 0.5,
+        colorscale=colorscale,
+        colorbar=dict(title='AQI Category', tickvals=list(range(n)), ticktext=AQI_CATEGORIES),
+        hovertemplate='Country Name=%{location}<br>AQI Category=%{text}<extra></extra>',
+        marker=dict(line=dict(width=0, color='silver')),
+    ))
+    figure.update_layout(
+        geo=dict(
+            center={'lat': 0, 'lon': 0},
+            projection_type='natural earth',
+            projection_scale=1
+        ),
+        margin={"r": 0, "t": 0, "l": 0, "b": 0},
+        clickmode='event+select',
+    )
+    return figure
+
+if __name__ == '__main__':
+    build_geometry()
+    for level in SIMPLIFY_TOLERANCE:
+        print(f"{geometry_path(level)}: {os.path.getsize(geometry_path(level)) / 1024:.0f} KiB")
@@ -0,0 +1,19 @@
+# Read by gunicorn when started from the src folder, e.g. `gunicorn app:server`.
+# The master imports the app once, loading the data and the map geometry, and
+# the workers fork from it with all of that already in memory.
+preload_app = True
+
+# Threaded workers, so a long /export stream holds one thread rather than a
+# whole worker, and the worker keeps answering gunicorn's heartbeat meanwhile
+threads = 4
+
+def when_ready(server):
+    # Importing the chart libraries is safe before the fork; starting their runtime is not
+    from callbacks import chart_libraries
+    chart_libraries()
+
+def post_worker_init(worker):
+    # The data watcher, the chart runtime and the initial layout are started in
+    # each worker before it takes its first request
+    import app
+    app.warm()
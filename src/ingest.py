@@ -0,0 +1,110 @@
+import argparse
+import datetime
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from data import (DATA_PATH, MEASUREMENT_SCHEMA, UPDATE_PARTITIONING, UPDATES_PATH,
+                  read_manifest, read_updates, write_manifest)
+from preprocess import CHUNK_ROWS, clean_chunk, read_raw
+
+WATERMARKS_NAME = '_watermarks.parquet'
+
+STATION_KEYS = ['coordinates', 'pollutant']
+
+BATCH_SCHEMA = MEASUREMENT_SCHEMA.append(pa.field('year_month', pa.string()))
+
+def watermarks_path(updates_path=UPDATES_PATH):
+    return os.path.join(updates_path, WATERMARKS_NAME)
+
+def latest_readings(rows):
+    return rows.groupby(STATION_KEYS, observed=True)['time_hour'].max()
+
+def read_watermarks(path=DATA_PATH, updates_path=UPDATES_PATH):
+    # Latest reading time of every station and pollutant already ingested. The
+    # file records the manifest version it matches and is rebuilt from the
+    # data when they differ, e.g. after an interrupted ingest.
+    manifest = read_manifest(updates_path)
+    if os.path.exists(watermarks_path(updates_path)):
+        table = pq.read_table(watermarks_path(updates_path))
+        if table.schema.metadata.get(b'version') == str(manifest['version']).encode():
+            return table.to_pandas().set_index(STATION_KEYS)['time_hour']
+
+    rows = pq.read_table(path, columns=STATION_KEYS + ['time_hour']).to_pandas()
+    if manifest['batches']:
+        updates = read_updates(updates_path, manifest['batches']).select(STATION_KEYS + ['time_hour'])
+        rows = pd.concat([rows, updates.to_pandas()], ignore_index=True)
+    return latest_readings(rows)
+
+def write_watermarks(watermarks, version, updates_path=UPDATES_PATH):
+    table = pa.Table.from_pandas(watermarks.reset_index(), preserve_index=False)
+    table = table.replace_schema_metadata({'version': str(version)})
+    pq.write_table(table, watermarks_path(updates_path))
+
+def unseen_rows(chunk, watermarks):
+    # Readings no newer than the latest one already ingested for their station
+    # and pollutant are dropped before any cleaning or AQI work
+    chunk = chunk.drop_duplicates(['Coordinates', 'Pollutant', 'Last Updated'])
+    time_hour = pd.to_datetime(chunk['Last Updated'], utc=True, format='ISO8601').dt.tz_convert(None)
+    stations = pd.MultiIndex.from_arrays([chunk['Coordinates'], chunk['Pollutant']])
+    latest = watermarks.reindex(stations).to_numpy(dtype='datetime64[ns]')
+    return chunk[~(time_hour.to_numpy() <= latest)]
+
+def write_batch(rows, updates_path, version, part):
+    # One file per (pollutant, year_month) partition touched by the rows
+    rows = rows.assign(year_month=rows['time'].dt.strftime('%Y-%m'))
+    table = pa.Table.from_pandas(rows, schema=BATCH_SCHEMA, preserve_index=False)
+    files = []
+    ds.write_dataset(table, updates_path, format='parquet', partitioning=UPDATE_PARTITIONING,
+                     basename_template=f'batch-{version:06d}-{part}-{{i}}.parquet',
+                     existing_data_behavior='overwrite_or_ignore',
+                     file_visitor=lambda file: files.append(os.path.relpath(file.path, updates_path)))
+    partitions = rows[['pollutant', 'year_month']].drop_duplicates().values.tolist()
+    return files, partitions
+
+def ingest(raw_path, path=DATA_PATH, updates_path=UPDATES_PATH, chunk_rows=CHUNK_ROWS):
+    # Appends the readings of a raw batch that are not in the dataset yet as new
+    # partition files, then publishes them with a new manifest version
+    os.makedirs(updates_path, exist_ok=True)
+    manifest = read_manifest(updates_path)
+    watermarks = read_watermarks(path, updates_path)
+    version = manifest['version'] + 1
+
+    files, partitions, rows = [], set(), 0
+    for part, chunk in enumerate(read_raw(raw_path, chunk_rows)):
+        new = clean_chunk(unseen_rows(chunk, watermarks))
+        if new.empty:
+            continue
+        written, touched = write_batch(new, updates_path, version, part)
+        files += written
+        partitions.update(map(tuple, touched))
+        rows += len(new)
+        watermarks = pd.concat([watermarks, latest_readings(new)]).groupby(level=STATION_KEYS).max()
+
+    if rows:
+        manifest['version'] = version
+        manifest['batches'].append({
+            'version': version,
+            'source': os.path.basename(raw_path),
+            'ingested_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'rows': rows,
+            'partitions': sorted(partitions),
+            'files': files,
+        })
+        write_manifest(manifest, updates_path)
+        write_watermarks(watermarks, version, updates_path)
+    return rows, sorted(partitions)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Append the new readings of a raw OpenAQ batch to the processed data')
+    parser.add_argument('raw')
+    parser.add_argument('--output', default=UPDATES_PATH)
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    args = parser.parse_args()
+    rows, partitions = ingest(args.raw, DATA_PATH, args.output, args.chunk_rows)
+    print(f"{rows} new rows in {len(partitions)} partitions")
+    for pollutant, year_month in partitions:
+        print(f"  pollutant={pollutant}/year_month={year_month}")
@@ -0,0 +1,181 @@
+import cProfile
+import functools
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from encoding import dumps
+from forks import reset_in_child
+
+# Upper bounds of the histogram buckets, in seconds and in bytes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PAYLOAD_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6)
+
+# Where a callback spends its time: selecting rows, computing statistics,
+# building the figure or spec, and turning the output into JSON
+PHASES = ('filter', 'aggregate', 'figure', 'serialize')
+
+# The call being measured on this thread, so phase() needs no handle to it
+current = threading.local()
+
+@contextmanager
+def phase(name):
+    record = getattr(current, 'record', None)
+    if record is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record['phases'][name] = record['phases'].get(name, 0.0) + time.perf_counter() - started
+
+def note_cache(hit):
+    # Reported by the result cache
+    record = getattr(current, 'record', None)
+    if record is not None:
+        record['cache'] = 'hit' if hit else 'miss'
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        for bound, count in zip(self.buckets, self.counts):
+            yield f"{name}_bucket{{{labels},le=\"{bound:g}\"}} {count}"
+        yield f"{name}_bucket{{{labels},le=\"+Inf\"}} {self.count}"
+        yield f"{name}_sum{{{labels}}} {self.sum:.6f}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+class CallbackMetrics:
+    # Latency, payload size and cache outcome of every instrumented callback,
+    # kept per process and rendered in the Prometheus text format. Each gunicorn
+    # worker reports its own calls; background jobs record in their job process
+    # and are not seen here.
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.payload = defaultdict(lambda: Histogram(PAYLOAD_BUCKETS))
+        self.cache = defaultdict(int)
+        self.lock = threading.Lock()
+        reset_in_child(self)
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+
+    def instrument(self, name):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args):
+                # Only the phases that run get an entry; a cache hit runs serialize alone
+                record = {'phases': {}, 'bytes': None, 'cache': None}
+                current.record = record
+                profile = self.profiling()
+                started = time.perf_counter()
+                result = None
+                try:
+                    if profile is None:
+                        result = func(*args)
+                    else:
+                        result = profile.runcall(func, *args)
+                    return result
+                finally:
+                    elapsed = time.perf_counter() - started
+                    current.record = None
+                    if profile is not None:
+                        self.dump(name, profile)
+                    if result is not None:
+                        # What goes on the wire: the returned output, often a Patch, with
+                        # the encoder Dash uses. Encoded again here, outside the timing.
+                        record['bytes'] = len(dumps(result).encode())
+                    self.observe(name, elapsed, record)
+            return wrapper
+        return decorator
+
+    def profiling(self):
+        # A request opts in with an X-Profile header, only when a dump directory is configured
+        if not self.profile_dir:
+            return None
+        from flask import has_request_context, request
+
+        if not has_request_context() or not request.headers.get('X-Profile'):
+            return None
+        return cProfile.Profile()
+
+    def dump(self, name, profile):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{name}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}.prof")
+        profile.dump_stats(path)
+
+    def observe(self, name, elapsed, record):
+        with self.lock:
+            # Hits and misses are timed apart, as a hit skips everything but serialize
+            result = record['cache'] or 'none'
+            self.latency[(name, 'total', result)].observe(elapsed)
+            for phase_name, seconds in record['phases'].items():
+                self.latency[(name, phase_name, result)].observe(seconds)
+            if record['bytes'] is not None:
+                self.payload[name].observe(record['bytes'])
+            if record['cache'] is not None:
+                self.cache[(name, record['cache'])] += 1
+
+    def render(self, gauges=None):
+        lines = [
+            '# HELP pollution_tracker_callback_seconds Wall time of a callback, in total and per phase.',
+            '# TYPE pollution_tracker_callback_seconds histogram',
+        ]
+        with self.lock:
+            for (name, phase_name, result), histogram in sorted(self.latency.items()):
+                lines.extend(histogram.samples('pollution_tracker_callback_seconds',
+                                               f'callback="{name}",phase="{phase_name}",cache="{result}"'))
+            lines += [
+                '# HELP pollution_tracker_callback_payload_bytes Size of the output a callback returns, serialized as JSON.',
+                '# TYPE pollution_tracker_callback_payload_bytes histogram',
+            ]
+            for name, histogram in sorted(self.payload.items()):
+                lines.extend(histogram.samples('pollution_tracker_callback_payload_bytes', f'callback="{name}"'))
+            lines += [
+                '# HELP pollution_tracker_callback_cache_total Callback calls answered from the result cache or computed.',
+                '# TYPE pollution_tracker_callback_cache_total counter',
+            ]
+            for (name, result), count in sorted(self.cache.items()):
+                lines.append(f'pollution_tracker_callback_cache_total{{callback="{name}",result="{result}"}} {count}')
+        for name, value in (gauges or {}).items():
+            name = 'pollution_tracker_' + re.sub(r'\W', '_', name)
+            lines += [f'# TYPE {name} gauge', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+class StartupTimer:
+    # Seconds spent in each start-up phase of this process, for the log and /metrics
+    def __init__(self, started):
+        self.phases = {}
+        self.last = started
+
+    def resume(self):
+        # Phases after a pause, such as a fork, are timed from now
+        self.last = time.perf_counter()
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases[name] = now - self.last
+        self.last = now
+
+    def report(self):
+        phases = ', '.join(f"{name} {seconds:.2f} s" for name, seconds in self.phases.items())
+        return f"{phases} (total {sum(self.phases.values()):.2f} s)"
+
+    def gauges(self):
+        return {f'startup_{name}_seconds': round(seconds, 6) for name, seconds in self.phases.items()}
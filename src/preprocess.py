@@ -0,0 +1,247 @@
+import argparse
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from data import AQI_CATEGORIES, DATA_PATH, MEASUREMENT_SCHEMA
+
+RAW_CSV = '../data/raw/world_air_quality.csv'
+
+# Rows of the raw OpenAQ export processed at a time, which bounds memory use
+CHUNK_ROWS = 500_000
+
+RAW_COLUMNS = {
+    'Country Code': 'country_code',
+    'Coordinates': 'coordinates',
+    'Pollutant': 'pollutant',
+    'Unit': 'unit',
+    'Value': 'value',
+    'Last Updated': 'time',
+    'Country Label': 'countryname',
+}
+
+# Pollutants with EPA AQI breakpoints; everything else is dropped
+AQI_POLLUTANTS = ['PM2.5', 'PM10', 'CO', 'SO2', 'NO2', 'O3']
+
+# Country names missing from the export, by country code
+COUNTRY_NAMES_BY_CODE = {
+    'XK': 'Kosovo',
+    'AJ': 'Azerbaijan',
+    'CE': 'Sri Lanka',
+    'UC': 'Curacao',
+    'TI': 'Tajikistan',
+    'IZ': 'Iraq',
+    'KU': 'Kuwait',
+    'BK': 'Bosnia-Herzegovina',
+    'VM': 'Vietnam',
+    'TX': 'Turkmenistan',
+    'KV': 'Kosovo',
+    'SU': 'Sudan',
+    'CS': 'Costa Rica',
+    'CW': 'Cook Islands',
+    'AQ': 'Antartica',
+}
+
+# Export names renamed to the names used by the map geometry
+COUNTRY_NAME_CORRECTIONS = {
+    "Czech Republic": "Czechia",
+    "Russian Federation": "Russia",
+    "Macedonia, The former Yugoslav Rep. of": "North Macedonia",
+    "Taiwan, China": "Taiwan",
+    "United States": "United States of America",
+    "Lao People's Dem. Rep.": "Laos",
+    "Moldova, Republic of": "Moldova",
+    "Serbia": "Republic of Serbia",
+    "Hong Kong, China": "China",
+    "West Bank and Gaza Strip": "Palestine",
+    "Viet Nam": "Vietnam",
+}
+
+DROPPED_COUNTRIES = ['Andorra', 'Gibraltar', 'Malta', 'USSR', 'Antartica']
+
+# Continents that the country code lookup misses or gets wrong, by country name
+CONTINENT_CORRECTIONS = {
+    'Antartica': 'Antartica',
+    'Azerbaijan': 'Asia',
+    'Bosnia-Herzegovina': 'Europe',
+    'Curacao': 'South America',
+    'Iraq': 'Asia',
+    'Kosovo': 'Europe',
+    'Kuwait': 'Asia',
+    'Serbia and Montenegro': 'Europe',
+    'Sri Lanka': 'Asia',
+    'Turkmenistan': 'Asia',
+    'Tajikistan': 'Asia',
+    'USSR': 'Asia',
+    'Vietnam': 'Asia',
+    'Russia': 'Asia',
+}
+
+# Divisors from µg/m³ to the unit the AQI breakpoints use, from
+# https://uk-air.defra.gov.uk/assets/documents/reports/cat06/0502160851_Conversion_Factors_Between_ppb_and.pdf
+UNIT_DIVISORS = {
+    ('O3', 'µg/m³'): 1.9957 * 1000,
+    ('CO', 'µg/m³'): 1.1642,
+    ('SO2', 'µg/m³'): 2.6609,
+    ('NO2', 'µg/m³'): 1.9125,
+}
+
+CONVERTED_UNITS = {
+    'O3': 'ppm',
+    'CO': 'ppm',
+    'SO2': 'ppb',
+    'NO2': 'ppb',
+}
+
+# AQI breakpoints (C_low, C_high, I_low, I_high), based on the US EPA system
+# https://aqs.epa.gov/aqsweb/documents/codetables/aqi_breakpoints.html
+AQI_BREAKPOINTS = {
+    'PM2.5': [(0.0, 12.0, 0, 50), (12.1, 35.4, 51, 100), (35.5, 55.4, 101, 150), (55.5, 150.4, 151, 200), (150.5, 250.4, 201, 300), (250.5, 350.4, 301, 400), (350.5, 500.4, 401, 500)],
+    'PM10': [(0, 54, 0, 50), (55, 154, 51, 100), (155, 254, 101, 150), (255, 354, 151, 200), (355, 424, 201, 300), (425, 504, 301, 400), (505, 604, 401, 500)],
+    'CO': [(0.0, 4.4, 0, 50), (4.5, 9.4, 51, 100), (9.5, 12.4, 101, 150), (12.5, 15.4, 151, 200), (15.5, 30.4, 201, 300), (30.5, 40.4, 301, 400), (40.5, 50.4, 401, 500)],
+    'SO2': [(0, 35, 0, 50), (36, 75, 51, 100), (76, 185, 101, 150), (186, 304, 151, 200), (305, 604, 201, 300), (605, 804, 301, 400), (805, 1004, 401, 500)],
+    'NO2': [(0, 53, 0, 50), (54, 100, 51, 100), (101, 360, 101, 150), (361, 649, 151, 200), (650, 1249, 201, 300), (1250, 1649, 301, 400), (1650, 2049, 401, 500)],
+    'O3': [(0.125, 0.164, 101, 150), (0.165, 0.204, 151, 200), (0.205, 0.404, 201, 300), (0.405, 0.504, 301, 400), (0.505, 0.604, 401, 500)],
+}
+
+CATEGORY_BREAKPOINTS = {
+    'PM2.5': [(0.0, 12.0, "Good"), (12.1, 35.4, "Moderate"), (35.5, 55.4, "Unhealthy for Sensitive Groups"), (55.5, 150.4, "Unhealthy"), (150.5, 250.4, "Very Unhealthy"), (250.5, 99999.9, "Hazardous")],
+    'PM10': [(0, 54, "Good"), (55, 154, "Moderate"), (155, 254, "Unhealthy for Sensitive Groups"), (255, 354, "Unhealthy"), (355, 424, "Very Unhealthy"), (425, 99999.9, "Hazardous")],
+    'CO': [(0.0, 4.4, "Good"), (4.5, 9.4, "Moderate"), (9.5, 12.4, "Unhealthy for Sensitive Groups"), (12.5, 15.4, "Unhealthy"), (15.5, 30.4, "Very Unhealthy"), (30.5, 99999.9, "Hazardous")],
+    'SO2': [(0, 35, "Good"), (36, 75, "Moderate"), (76, 185, "Unhealthy for Sensitive Groups"), (186, 304, "Unhealthy"), (305, 604, "Very Unhealthy"), (605, 99999.9, "Hazardous")],
+    'NO2': [(0, 53, "Good"), (54, 100, "Moderate"), (101, 360, "Unhealthy for Sensitive Groups"), (361, 649, "Unhealthy"), (650, 1249, "Very Unhealthy"), (1250, 99999.9, "Hazardous")],
+    'O3': [(0, 0.124, "Good"), (0.125, 0.164, "Unhealthy for Sensitive Groups"), (0.165, 0.204, "Unhealthy"), (0.205, 0.404, "Very Unhealthy"), (0.405, 99999.9, "Hazardous")],
+}
+
+def breakpoint_arrays(breakpoints):
+    # One array per breakpoint field for each pollutant, with categories as codes
+    arrays = {}
+    for pollutant, rows in breakpoints.items():
+        rows = [[AQI_CATEGORIES.index(field) if isinstance(field, str) else field for field in row]
+                for row in rows]
+        arrays[pollutant] = np.array(rows, dtype=float).T
+    return arrays
+
+AQI_ARRAYS = breakpoint_arrays(AQI_BREAKPOINTS)
+CATEGORY_ARRAYS = breakpoint_arrays(CATEGORY_BREAKPOINTS)
+
+def find_breakpoints(concentrations, low, high):
+    # Index of the breakpoint interval holding each concentration; -1 when it
+    # falls outside every interval, including the gaps between them
+    index = np.searchsorted(low, concentrations, side='right') - 1
+    found = (index >= 0) & (concentrations <= high[np.maximum(index, 0)])
+    return np.where(found, index, -1)
+
+def compute_aqi(pollutants, concentrations):
+    # AQI by linear interpolation within each pollutant's breakpoint interval,
+    # plus the category code (-1 when there is none)
+    concentrations = np.asarray(concentrations, dtype=float)
+    aqi = np.full(len(concentrations), np.nan)
+    categories = np.full(len(concentrations), -1, dtype=np.int8)
+    codes, uniques = pd.factorize(pollutants)
+    for code, pollutant in enumerate(uniques):
+        if pollutant not in AQI_ARRAYS:
+            continue
+        rows = np.flatnonzero(codes == code)
+        c = concentrations[rows]
+
+        c_low, c_high, i_low, i_high = AQI_ARRAYS[pollutant]
+        index = find_breakpoints(c, c_low, c_high)
+        found = index >= 0
+        i = index[found]
+        aqi[rows[found]] = (i_high[i] - i_low[i]) / (c_high[i] - c_low[i]) * (c[found] - c_low[i]) + i_low[i]
+
+        c_low, c_high, category = CATEGORY_ARRAYS[pollutant]
+        index = find_breakpoints(c, c_low, c_high)
+        found = index >= 0
+        categories[rows[found]] = category[index[found]]
+    return aqi, categories
+
+@functools.lru_cache(maxsize=None)
+def continent_of(country_code):
+    import pycountry_convert as pc
+
+    try:
+        continent_code = pc.country_alpha2_to_continent_code(country_code)
+        return pc.convert_continent_code_to_continent_name(continent_code)
+    except KeyError:
+        return None
+
+def continents(country_codes):
+    # The lookup runs once per distinct code and is joined back onto the rows
+    lookup = {code: continent_of(code) for code in country_codes.dropna().unique()}
+    return country_codes.map(lookup)
+
+def convert_units(chunk):
+    index = pd.MultiIndex.from_arrays([chunk['pollutant'], chunk['unit']])
+    divisors = pd.Series(UNIT_DIVISORS).reindex(index).fillna(1.0).to_numpy()
+    value = chunk['value'].to_numpy() / divisors
+    unit = chunk['pollutant'].map(CONVERTED_UNITS).fillna(chunk['unit'])
+    return value, unit
+
+def clean_chunk(chunk):
+    chunk = chunk.rename(columns=RAW_COLUMNS)
+    # Only 6 PM2.5 observations are in ppm rather than µg/m³, so they are dropped.
+    # Negative concentrations are measurement errors.
+    chunk = chunk[chunk['pollutant'].isin(AQI_POLLUTANTS)
+                  & ~((chunk['pollutant'] == 'PM2.5') & (chunk['unit'] == 'ppm'))
+                  & (chunk['value'] >= 0)]
+
+    names = chunk['countryname'].fillna(chunk['country_code'].map(COUNTRY_NAMES_BY_CODE))
+    names = names.map(COUNTRY_NAME_CORRECTIONS).fillna(names)
+    keep = ~names.isin(DROPPED_COUNTRIES)
+    chunk, names = chunk[keep], names[keep]
+    continent = names.map(CONTINENT_CORRECTIONS).fillna(continents(chunk['country_code']))
+
+    # As in the original notebook, AQI is computed from the concentration as
+    # reported, before unit conversion
+    aqi, categories = compute_aqi(chunk['pollutant'], chunk['value'])
+    value, unit = convert_units(chunk)
+
+    # time is the local date of the reading, time_hour the reading time in UTC
+    time = pd.to_datetime(chunk['time'].str[:10], format='%Y-%m-%d')
+    time_hour = pd.to_datetime(chunk['time'], utc=True, format='ISO8601').dt.tz_convert(None)
+
+    return pd.DataFrame({
+        'coordinates': chunk['coordinates'],
+        'pollutant': chunk['pollutant'],
+        'time': time,
+        'countryname': names,
+        'time_hour': time_hour,
+        'continent': continent,
+        'value': value,
+        'unit': unit,
+        'AQI': aqi,
+        'AQI_cat': np.array(AQI_CATEGORIES + [None], dtype=object)[categories],
+    })
+
+def read_raw(raw_path=RAW_CSV, chunk_rows=CHUNK_ROWS):
+    return pd.read_csv(raw_path, sep=';', usecols=list(RAW_COLUMNS),
+                       dtype={column: str for column in RAW_COLUMNS if column != 'Value'},
+                       chunksize=chunk_rows)
+
+def preprocess(raw_path=RAW_CSV, path=DATA_PATH, chunk_rows=CHUNK_ROWS):
+    # Streams the raw export through clean_chunk one chunk at a time and appends
+    # each as a row group, so memory use does not grow with the size of the dump
+    rows = 0
+    partial = f"{path}.{os.getpid()}.partial"
+    with pq.ParquetWriter(partial, MEASUREMENT_SCHEMA) as writer:
+        for chunk in read_raw(raw_path, chunk_rows):
+            table = pa.Table.from_pandas(clean_chunk(chunk), schema=MEASUREMENT_SCHEMA, preserve_index=False)
+            writer.write_table(table)
+            rows += table.num_rows
+    os.replace(partial, path)
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the processed parquet file from a raw OpenAQ export')
+    parser.add_argument('--raw', default=RAW_CSV)
+    parser.add_argument('--output', default=DATA_PATH)
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    args = parser.parse_args()
+    rows = preprocess(args.raw, args.output, args.chunk_rows)
+    print(f"{args.output}: {rows} rows")
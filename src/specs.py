@@ -0,0 +1,67 @@
+import json
+import re
+
+import pandas as pd
+
+# Inline values are rounded to this many decimals; tooltips show two
+FLOAT_DIGITS = 3
+
+# Timestamps as VegaFusion writes them, without a time zone
+ISO_TIMESTAMP = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?$')
+
+# Field names Vega would read as a path into nested objects
+NESTED_FIELD = re.compile(r'[.\[\]]')
+
+def to_date_formula(field):
+    return {'type': 'formula', 'expr': f"toDate(datum['{field}'])", 'as': field}
+
+def local_date_formula(field):
+    # The epoch is the naive timestamp read as UTC, so its UTC parts are the
+    # local date and time toDate() gave for the ISO string
+    value = f"datum['{field}']"
+    parts = ', '.join(f"utc{part}({value})"
+                      for part in ('year', 'month', 'date', 'hours', 'minutes', 'seconds', 'milliseconds'))
+    return {'type': 'formula', 'expr': f"datetime({parts})", 'as': field}
+
+def is_timestamp_column(values):
+    return all(value is None or (isinstance(value, str) and ISO_TIMESTAMP.match(value)) for value in values)
+
+def epoch_milliseconds(values):
+    times = pd.to_datetime(pd.Series(values, dtype=object), format='ISO8601')
+    epochs = times.to_numpy(dtype='datetime64[ms]').astype('int64').tolist()
+    return [None if pd.isna(time) else epoch for time, epoch in zip(times, epochs)]
+
+def round_floats(values):
+    return [round(value, FLOAT_DIGITS) if isinstance(value, float) else value for value in values]
+
+def compact_data(data):
+    # Inline rows become one row of parallel column arrays, which a flatten
+    # transform expands again in the browser, so the field names are sent once
+    # per column instead of once per value. Timestamps that the spec parses with
+    # toDate() are sent as epoch milliseconds.
+    values = data.get('values')
+    if not values or len(values) < 2:
+        return data
+    columns = list(values[0])
+    if any(NESTED_FIELD.search(column) for column in columns) or any(list(row) != columns for row in values):
+        return data
+
+    transform = list(data.get('transform', []))
+    arrays = {}
+    for column in columns:
+        array = [row[column] for row in values]
+        parse = to_date_formula(column)
+        if parse in transform and is_timestamp_column(array):
+            transform[transform.index(parse)] = local_date_formula(column)
+            array = epoch_milliseconds(array)
+        arrays[column] = round_floats(array)
+    compacted = dict(data, values=[arrays], transform=[{'type': 'flatten', 'fields': columns}] + transform)
+    # With only a few rows the flatten transform can outweigh the saving
+    return compacted if len(json.dumps(compacted)) < len(json.dumps(data)) else data
+
+def compact_spec(spec):
+    return dict(spec, data=[compact_data(data) for data in spec.get('data', [])])
+
+def spec_skeleton(spec):
+    # Everything but the data; for a given chart it does not depend on the filters
+    return json.dumps({key: value for key, value in spec.items() if key != 'data'}, sort_keys=True)
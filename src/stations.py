@@ -0,0 +1,189 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from aggregate import category_counts, category_mode, group_statistics, mode_of_counts
+from data import AQI_CATEGORIES, CATEGORY_COLORS
+
+# OpenAQ writes a station's position as "lat, lon"; anything after it is ignored
+COORDINATES_PATTERN = r'^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)'
+
+# Side of a grid cell of the station index, in degrees
+GRID_DEGREES = 1.0
+
+# Most markers drawn for one viewport; with more stations in view they are
+# clustered on a grid of CLUSTER_CELLS cells across the wider side of the view
+MAX_STATION_MARKERS = 1000
+CLUSTER_CELLS = 40
+
+EARTH_RADIUS_KM = 6371.0
+
+WORLD_VIEWPORT = dict(south=-90, west=-180, north=90, east=180)
+
+def parse_coordinates(names):
+    parts = pd.Series(names, dtype=object).str.extract(COORDINATES_PATTERN).astype(float)
+    return parts[0].to_numpy(), parts[1].to_numpy()
+
+def haversine_km(lat, lon, lats, lons):
+    lat, lon, lats, lons = map(np.radians, (lat, lon, lats, lons))
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+def station_totals(rows):
+    # Mean AQI, reading count, country, continent and most frequent AQI
+    # category of every station in a slice of measurements
+    rows = rows[rows['AQI'].notna() & rows['coordinates'].notna()]
+    if not isinstance(rows['AQI_cat'].dtype, pd.CategoricalDtype):
+        rows = rows.assign(AQI_cat=pd.Categorical(rows['AQI_cat'], categories=AQI_CATEGORIES, ordered=True))
+    totals = group_statistics(rows, 'coordinates', 'AQI', ('mean', 'count'), first=('countryname', 'continent'))
+    totals['AQI_cat'] = category_mode(rows, 'coordinates')
+    return totals
+
+class StationIndex:
+    # Stations bucketed into a lat/lon grid and sorted by cell, so the stations
+    # of a run of cells along one grid row are one contiguous slice. A box
+    # query reads one slice per grid row it covers.
+    def __init__(self, totals, grid_degrees=GRID_DEGREES):
+        lat, lon = parse_coordinates(totals.index)
+        valid = (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+        self.grid_degrees = grid_degrees
+        self.n_rows = int(np.ceil(180 / grid_degrees))
+        self.n_cols = int(np.ceil(360 / grid_degrees))
+
+        cells = self.cell(lat[valid], lon[valid])
+        order = np.argsort(cells, kind='stable')
+        self.stations = (totals[valid].iloc[order]
+                         .assign(lat=lat[valid][order], lon=lon[valid][order])
+                         .rename_axis('station').reset_index())
+        self.lat = self.stations['lat'].to_numpy()
+        self.lon = self.stations['lon'].to_numpy()
+        self.starts = np.searchsorted(cells[order], np.arange(self.n_rows * self.n_cols + 1))
+
+    def __len__(self):
+        return len(self.stations)
+
+    def cell(self, lat, lon):
+        rows = np.clip(((np.asarray(lat) + 90) // self.grid_degrees).astype(int), 0, self.n_rows - 1)
+        cols = np.clip(((np.asarray(lon) + 180) // self.grid_degrees).astype(int), 0, self.n_cols - 1)
+        return rows * self.n_cols + cols
+
+    def in_box(self, south, west, north, east):
+        # Positions of the stations inside a box. A box whose west edge is east
+        # of its east edge, or whose longitudes run past 180, wraps the antimeridian.
+        south, north = max(south, -90), min(north, 90)
+        if south > north:
+            return np.array([], dtype=int)
+        if east - west >= 360:
+            spans = [(-180, 180)]
+        else:
+            west, east = (west + 180) % 360 - 180, (east + 180) % 360 - 180
+            spans = [(west, east)] if west <= east else [(west, 180), (-180, east)]
+
+        found = []
+        for west, east in spans:
+            first_row, first_col = divmod(int(self.cell(south, west)), self.n_cols)
+            last_row, last_col = divmod(int(self.cell(north, east)), self.n_cols)
+            candidates = np.concatenate([
+                np.arange(self.starts[row * self.n_cols + first_col], self.starts[row * self.n_cols + last_col + 1])
+                for row in range(first_row, last_row + 1)
+                ])
+            # Cells are coarser than the box, so the candidates are checked exactly
+            lat, lon = self.lat[candidates], self.lon[candidates]
+            found.append(candidates[(lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)])
+        return np.concatenate(found)
+
+    def nearest(self, lat, lon, k=1):
+        # The k closest stations and their distances in km. The search box is
+        # doubled until its k-th closest station is nearer than any point
+        # outside the box can be.
+        half = self.grid_degrees
+        while True:
+            if half >= 180:
+                candidates = np.arange(len(self))
+            else:
+                candidates = self.in_box(lat - half, lon - half, lat + half, lon + half)
+            distances = haversine_km(lat, lon, self.lat[candidates], self.lon[candidates])
+            order = np.argsort(distances, kind='stable')[:k]
+            reach = EARTH_RADIUS_KM * min(np.radians(half),
+                                          np.arcsin(np.sin(np.radians(min(half, 90))) * np.cos(np.radians(lat))))
+            if half >= 180 or (len(order) == k and distances[order[-1]] <= reach):
+                return candidates[order], distances[order]
+            half *= 2
+
+def normalize_viewport(south, west, north, east):
+    # Longitudes from west to east with east >= west, spanning at most 360 degrees
+    if east - west >= 360:
+        return south, -180, north, 180
+    west = (west + 180) % 360 - 180
+    east = west + (east - west) % 360
+    return south, west, north, east
+
+def cluster_stations(stations, south, west, north, east, cells=CLUSTER_CELLS):
+    # Groups stations on a grid laid over a normalized viewport. Each cluster
+    # sits at the mean position of its stations and takes their mean AQI and
+    # most frequent category. Longitudes are unwrapped from the west edge, so a
+    # viewport across the antimeridian clusters like any other.
+    lon = (stations['lon'].to_numpy() - west) % 360 + west
+    size = max(north - south, east - west) / cells
+    keys = ((stations['lat'].to_numpy() - south) // size).astype(int) * (cells * 4) + ((lon - west) // size).astype(int)
+    codes, groups = pd.factorize(keys)
+    counts = np.bincount(codes, minlength=len(groups))
+    categories = stations['AQI_cat'].cat.codes.to_numpy()
+    modes = mode_of_counts(category_counts(codes, len(groups), categories, len(AQI_CATEGORIES)), AQI_CATEGORIES)
+    mean_lon = np.bincount(codes, lon, minlength=len(groups)) / counts
+    return pd.DataFrame({
+        'lat': np.bincount(codes, stations['lat'].to_numpy(), minlength=len(groups)) / counts,
+        'lon': (mean_lon + 180) % 360 - 180,
+        'mean': np.bincount(codes, stations['mean'].to_numpy(), minlength=len(groups)) / counts,
+        'stations': counts,
+        'AQI_cat': modes,
+    })
+
+def station_markers(index, south, west, north, east):
+    # Values of the station map trace for a viewport, and a line describing them
+    south, west, north, east = normalize_viewport(south, west, north, east)
+    stations = index.stations.iloc[index.in_box(south, west, north, east)]
+
+    if stations.empty:
+        status = 'No stations in view.'
+        if len(index):
+            lat, lon = (south + north) / 2, ((west + east) / 2 + 180) % 360 - 180
+            (nearest,), (distance,) = index.nearest(lat, lon)
+            station = index.stations.iloc[nearest]
+            status += f" The nearest is in {station['countryname']}, {distance:,.0f} km from the centre of the map."
+        return dict(lat=[], lon=[], text=[], marker=dict(size=[], color=[])), status
+
+    if len(stations) <= MAX_STATION_MARKERS:
+        text = [f"{country}<br>{station}<br>Mean AQI {mean:.1f} ({category})<br>{count:,} readings"
+                for country, station, mean, category, count in zip(
+                    stations['countryname'], stations['station'], stations['mean'],
+                    stations['AQI_cat'], stations['count'])]
+        sizes = [8] * len(stations)
+        status = f"{len(stations):,} stations in view."
+    else:
+        clusters = cluster_stations(stations, south, west, north, east)
+        text = [f"{count:,} stations<br>Mean AQI {mean:.1f}<br>Mostly {category}"
+                for count, mean, category in zip(clusters['stations'], clusters['mean'], clusters['AQI_cat'])]
+        sizes = (8 + 4 * np.log2(clusters['stations'])).round(1).tolist()
+        status = f"{len(stations):,} stations in view, grouped into {len(clusters):,} clusters. Zoom in to see single stations."
+        stations = clusters
+
+    colors = [CATEGORY_COLORS.get(category, 'silver') for category in stations['AQI_cat']]
+    values = dict(lat=stations['lat'].round(5).tolist(), lon=stations['lon'].round(5).tolist(),
+                  text=text, marker=dict(size=sizes, color=colors))
+    return values, status
+
+def base_station_map():
+    # Filter and viewport changes patch the points of this trace; uirevision
+    # keeps the viewport the user chose when they do
+    figure = go.Figure(go.Scattermapbox(
+        lat=[], lon=[], text=[], mode='markers',
+        marker=dict(size=[], color=[], opacity=0.8),
+        hovertemplate='%{text}<extra></extra>',
+    ))
+    figure.update_layout(
+        mapbox=dict(style='carto-positron', center={'lat': 20, 'lon': 0}, zoom=0.6),
+        margin={"r": 0, "t": 0, "l": 0, "b": 0},
+        uirevision='stations',
+    )
+    return figure